@@ -1,9 +1,10 @@
 #!/usr/bin/env python3
 
 from loguru import logger
-from typing import Tuple
+from typing import Any, Iterator, List, Set, Tuple
 from pathlib import Path
-import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import json
 import subprocess
 
 def is_remote_file(file_path: str) -> bool:
@@ -18,17 +19,19 @@ def check_arguments(args) -> bool:
     return True
 
 
-# Returns the file path to the downloaded file and the thumbnail (if downloaded)
-def download(media_url: str, destination_directory: Path, audio_format: str, get_thumbnail: bool) -> Tuple[str, str]:
+# Returns the file path to the downloaded file, the thumbnail (if downloaded) and the info JSON
+def download(media_url: str, destination_directory: Path, audio_format: str, get_thumbnail: bool) -> Tuple[str, str, str]:
     logger.trace('Downloading from {} to directory {} as {} and fetching thumbnail: {}.', media_url, destination_directory, audio_format, get_thumbnail)
-    orig_wd = os.getcwd()
-    os.chdir(destination_directory)
+    # absolute, so the returned paths do not depend on the working directory
+    # parallel downloads must get an already absolute path, see download_entries
+    destination_directory = Path(destination_directory).resolve()
 
     yt_dlp_args = [
         'yt-dlp',
         # suppress any output besides the requested prints
         # warnings and errors are still printed to stderr
         '-q',
+        '--paths', str(destination_directory),
     ]
 
     if get_thumbnail:
@@ -36,8 +39,11 @@ def download(media_url: str, destination_directory: Path, audio_format: str, get
 
     yt_dlp_args.extend([
         '--restrict-filenames',
-        # prints the absolute path to the output file to stdout
-        '--exec', 'echo %(filepath)q',
+        # metadata like chapters and the description, used as track list
+        '--write-info-json',
+        # prints the absolute path to the final output file to stdout
+        '--print', 'after_move:filepath',
+        '--no-simulate',
         '--convert-thumbnails', 'jpg',
         # extract audio as requested format
         '-x', '--audio-format', audio_format,
@@ -56,8 +62,101 @@ def download(media_url: str, destination_directory: Path, audio_format: str, get
     thumbnail_path = None
     if get_thumbnail:
         thumbnail_path = Path(media_output_path).stem + '.jpg'
-        thumbnail_path = Path(destination_directory).joinpath(thumbnail_path)
+        thumbnail_path = destination_directory.joinpath(thumbnail_path)
 
-    os.chdir(orig_wd)
+    info_json_path = str(destination_directory.joinpath(Path(media_output_path).stem + '.info.json'))
 
-    return media_output_path, thumbnail_path
+    return media_output_path, thumbnail_path, info_json_path
+
+
+# Returns the flat info JSON of a playlist, channel or tab, the entries are not resolved.
+def get_flat_info(playlist_url: str) -> dict:
+    yt_dlp_args = [
+        'yt-dlp',
+        '--flat-playlist',
+        '--dump-single-json',
+        playlist_url,
+    ]
+    logger.trace('Calling yt-dlp with arguments: {}.', yt_dlp_args)
+    proc = subprocess.run(yt_dlp_args, capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise ValueError('Listing entries of {} with yt-dlp failed with code {}, stderr: {}.'.format(playlist_url, proc.returncode, proc.stderr))
+    return json.loads(proc.stdout)
+
+
+# Whether a flat entry links to a list of videos instead of a video,
+# e.g. the tabs (videos, shorts, live) of a YouTube channel are entries of the YoutubeTab extractor.
+def is_playlist_entry(entry: dict) -> bool:
+    extractor = entry.get('ie_key') or ''
+    return entry.get('_type') == 'url' and any(kind in extractor for kind in ['Tab', 'Playlist', 'Channel'])
+
+
+# Lists all entries of a playlist or channel without downloading them.
+# Each entry is a dict from the yt-dlp info JSON with at least "id" and "url".
+def list_entries(playlist_url: str) -> List[dict]:
+    entries = []
+    keys = set()
+    listed = set([playlist_url])
+    pending = [get_flat_info(playlist_url)]
+    while len(pending) > 0:
+        info = pending.pop(0)
+        if info.get('_type') == 'playlist' or 'entries' in info:
+            pending.extend(e for e in info.get('entries') or [] if e is not None)
+            continue
+        url = info.get('url') or info.get('webpage_url')
+        if url is None or info.get('id') is None:
+            logger.debug('Ignoring entry without URL or id: {}.', info)
+            continue
+        if is_playlist_entry(info):
+            # a channel lists its tabs, these have to be listed on their own
+            if url not in listed:
+                logger.debug('Listing {} ({}) of {}.', url, info.get('ie_key'), playlist_url)
+                listed.add(url)
+                pending.append(get_flat_info(url))
+            continue
+        info['url'] = url
+        # e.g. a video in several playlists of a channel
+        if get_archive_key(info) in keys:
+            continue
+        keys.add(get_archive_key(info))
+        entries.append(info)
+
+    logger.debug('Found {} entries in {}.', len(entries), playlist_url)
+    return entries
+
+
+# key of an entry in the download archive, the same format yt-dlp uses for --download-archive
+def get_archive_key(entry: dict) -> str:
+    extractor = entry.get('ie_key') or entry.get('extractor_key') or entry.get('extractor') or ''
+    return '{} {}'.format(extractor.lower(), entry['id'])
+
+
+def read_archive(archive_path: str or None) -> Set[str]:
+    if archive_path is None or not Path(archive_path).exists():
+        return set()
+    with open(archive_path, 'r') as f:
+        return set(line.strip() for line in f if len(line.strip()) > 0)
+
+
+def add_to_archive(archive_path: str or None, entry: dict) -> None:
+    if archive_path is None:
+        return
+    with open(archive_path, 'a') as f:
+        f.write(get_archive_key(entry) + '\n')
+
+
+# Downloads the entries with at most max_concurrent downloads at the same time.
+# Yields (entry, (media, thumbnail, info JSON)) or (entry, exception) as soon as each download finishes,
+# so the caller can process finished downloads while the others are still running.
+def download_entries(entries: List[dict], destination_directory: Path, audio_format: str, get_thumbnail: bool,
+                     max_concurrent: int) -> Iterator[Tuple[dict, Any]]:
+    # resolved before any download starts, the working directory might change while processing
+    destination_directory = Path(destination_directory).resolve()
+    with ThreadPoolExecutor(max_concurrent) as executor:
+        futures = {executor.submit(download, entry['url'], destination_directory, audio_format, get_thumbnail): entry for entry in entries}
+        for future in as_completed(futures):
+            entry = futures[future]
+            try:
+                yield entry, future.result()
+            except Exception as e:
+                yield entry, e
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+
+from loguru import logger
+from typing import List, Tuple
+from pathlib import Path
+import os
+import sqlite3
+import unicodedata
+import music_tag
+
+from recognize import Track
+
+
+# what to do with a fragment that is already in the library
+DUPLICATE_MODES = ['keep', 'skip', 'hardlink', 'best']
+
+LOSSLESS_EXTENSIONS = ['.flac', '.wav', '.aiff', '.aif', '.alac', '.ape', '.wv']
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS tracks (
+        id INTEGER PRIMARY KEY,
+        file_path TEXT NOT NULL UNIQUE,
+        title TEXT,
+        artist TEXT,
+        album TEXT,
+        year TEXT,
+        fingerprint TEXT,
+        title_key TEXT,
+        artist_key TEXT,
+        lossless INTEGER NOT NULL DEFAULT 0,
+        bitrate INTEGER NOT NULL DEFAULT 0
+    )''',
+    # both ways of finding a track must stay fast with a big library
+    'CREATE INDEX IF NOT EXISTS tracks_fingerprint ON tracks (fingerprint)',
+    'CREATE INDEX IF NOT EXISTS tracks_name ON tracks (artist_key, title_key)',
+]
+
+
+# normalized title or artist for comparisons, ignores case, accents and whitespace differences
+def normalize(s: str or None) -> str or None:
+    if s is None:
+        return None
+    s = unicodedata.normalize('NFKD', s)
+    s = ''.join(c for c in s if not unicodedata.combining(c))
+    return ' '.join(s.casefold().split())
+
+
+# (lossless, bitrate) of a file, compares higher for the better copy
+def get_quality(file_path: str) -> Tuple[int, int]:
+    lossless = 1 if Path(file_path).suffix.lower() in LOSSLESS_EXTENSIONS else 0
+    bitrate = 0
+    try:
+        bitrate = music_tag.load_file(file_path)['#bitrate'].value or 0
+    except Exception as e:
+        logger.debug('Unable to read bitrate of {}: {}', file_path, e)
+    return lossless, bitrate
+
+
+# Persistent index of all recognized tracks over all processed mixes.
+class Library:
+    def __init__(self, database_path: str):
+        self.database_path = database_path
+        self.connection = sqlite3.connect(database_path)
+        self.connection.row_factory = sqlite3.Row
+        # allows reading while another job writes
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        with self.connection:
+            for statement in SCHEMA:
+                self.connection.execute(statement)
+
+    def close(self) -> None:
+        self.connection.close()
+
+    # Returns the best copy of the track in the library or None.
+    # Matches by fingerprint if known, otherwise by artist and title.
+    # Copies in the format of the track come first, only those can be hardlinked.
+    def find(self, track: Track) -> sqlite3.Row or None:
+        rows = []
+        if track.fingerprint is not None:
+            rows = self.connection.execute(
+                'SELECT * FROM tracks WHERE fingerprint = ? ORDER BY lossless DESC, bitrate DESC',
+                (track.fingerprint,)).fetchall()
+        if len(rows) == 0 and track.title is not None and track.artist is not None:
+            rows = self.connection.execute(
+                'SELECT * FROM tracks WHERE artist_key = ? AND title_key = ? ORDER BY lossless DESC, bitrate DESC',
+                (normalize(track.artist), normalize(track.title))).fetchall()
+        # stable, so the best copy in the same format comes first
+        suffix = Path(track.file_path).suffix.lower()
+        rows = sorted(rows, key=lambda row: Path(row['file_path']).suffix.lower() != suffix)
+        # ignore entries whose file got deleted
+        for row in rows:
+            if Path(row['file_path']).exists() and row['file_path'] != track.file_path:
+                return row
+        return None
+
+    def find_all(self, fingerprint: str or None, title: str or None, artist: str or None) -> List[sqlite3.Row]:
+        if fingerprint is not None:
+            return self.connection.execute('SELECT * FROM tracks WHERE fingerprint = ?', (fingerprint,)).fetchall()
+        return self.connection.execute('SELECT * FROM tracks WHERE artist_key = ? AND title_key = ?',
+            (normalize(artist), normalize(title))).fetchall()
+
+    # file_path overrides the path of the track, e.g. for hardlinks to it
+    def add(self, track: Track, file_path: str or None = None) -> None:
+        if track.title is None:
+            # unrecognized tracks can not be matched later on anyway
+            return
+        file_path = track.file_path if file_path is None else file_path
+        lossless, bitrate = get_quality(file_path)
+        with self.connection:
+            self.connection.execute(
+                '''INSERT INTO tracks (file_path, title, artist, album, year, fingerprint, title_key, artist_key, lossless, bitrate)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (file_path) DO UPDATE SET
+                    title = excluded.title, artist = excluded.artist, album = excluded.album, year = excluded.year,
+                    fingerprint = excluded.fingerprint, title_key = excluded.title_key, artist_key = excluded.artist_key,
+                    lossless = excluded.lossless, bitrate = excluded.bitrate''',
+                (str(file_path), track.title, track.artist, track.album, track.year, track.fingerprint,
+                 normalize(track.title), normalize(track.artist), lossless, bitrate))
+        logger.trace('Added {} to library {}.', track, self.database_path)
+
+    def move(self, old_path: str, new_path: str) -> None:
+        with self.connection:
+            self.connection.execute('UPDATE tracks SET file_path = ? WHERE file_path = ?', (str(new_path), str(old_path)))
+
+    # many moves in one transaction, paths may be swapped between the moves
+    def move_all(self, moves: List[Tuple[str, str]]) -> None:
+        with self.connection:
+            # a temporary path first, the unique file_path would reject swapped paths otherwise
+            self.connection.executemany('UPDATE tracks SET file_path = ? WHERE file_path = ?',
+                [('moving:' + str(new_path), str(old_path)) for old_path, new_path in moves])
+            # files that got replaced by the moves
+            self.connection.executemany('DELETE FROM tracks WHERE file_path = ?',
+                [(str(new_path),) for _, new_path in moves])
+            self.connection.executemany('UPDATE tracks SET file_path = ? WHERE file_path = ?',
+                [(str(new_path), 'moving:' + str(new_path)) for _, new_path in moves])
+
+
+def check_arguments(args) -> bool:
+    if args.library_duplicates != 'keep' and args.library_path is None:
+        print('--library-duplicates requires --library-path.')
+        return False
+    return True
+
+
+def get_library_from_arguments(args) -> Library or None:
+    if args.library_path is None:
+        return None
+    return Library(args.library_path)
+
+
+# replaces destination with a hardlink to source
+def replace_with_hardlink(source: str, destination: str) -> bool:
+    temp_path = str(destination) + '.link'
+    try:
+        os.link(source, temp_path)
+        os.replace(temp_path, destination)
+        return True
+    except OSError as e:
+        # e.g. different file systems
+        logger.warning('Unable to hardlink {} to {}, keeping the copy: {}', destination, source, e)
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+        return False
+
+
+# Handles fragments that are already in the library, must be called before renaming and tagging.
+# - keep: do nothing
+# - skip: delete the fragment and drop it from the returned tracks
+# - hardlink: replace the fragment with a hardlink to the library copy
+# - best: like hardlink if the library copy is at least as good,
+#   otherwise keep the fragment and replace the library copies with hardlinks to it after tagging
+# Hardlinked fragments share the tags of the library copy, they are marked as library_duplicate and not tagged again.
+# Only the primary format is hardlinked, additional formats are kept unless skipped.
+def deduplicate_tracks(tracks: List[Track], library: Library, mode: str) -> List[Track]:
+    if mode == 'keep':
+        return tracks
+
+    result = []
+    duplicates = 0
+    for track in tracks:
+        existing = library.find(track)
+        if existing is None:
+            result.append(track)
+            continue
+        duplicates += 1
+        logger.debug('{} is already in the library at {}.', track, existing['file_path'])
+
+        if mode == 'skip':
+            for file_path in track.all_file_paths():
+                os.remove(file_path)
+            continue
+
+        if mode == 'best' and get_quality(track.file_path) > (existing['lossless'], existing['bitrate']):
+            logger.debug('{} is better than the library copy, replacing it after tagging.', track.file_path)
+            track.replaces_library_copy = True
+        elif Path(existing['file_path']).suffix == Path(track.file_path).suffix and replace_with_hardlink(existing['file_path'], track.file_path):
+            track.library_duplicate = True
+        result.append(track)
+
+    logger.debug('{} of {} tracks already in the library, mode {}.', duplicates, len(tracks), mode)
+    return result
+
+
+# Replaces the worse library copies with hardlinks to the tracks marked by deduplicate_tracks, must be called after tagging.
+def replace_library_copies(tracks: List[Track], library: Library) -> None:
+    for track in tracks:
+        if not track.replaces_library_copy:
+            continue
+        for row in library.find_all(track.fingerprint, track.title, track.artist):
+            if row['file_path'] == track.file_path or not Path(row['file_path']).exists():
+                continue
+            # the link keeps the name and therefore the extension of the old copy
+            if Path(row['file_path']).suffix != Path(track.file_path).suffix:
+                continue
+            if replace_with_hardlink(track.file_path, row['file_path']):
+                library.add(track, row['file_path'])
+                logger.debug('Replaced library copy {} with {}.', row['file_path'], track.file_path)
@@ -14,6 +14,9 @@ import recognize
 import rename
 import tag
 import playlist
+import library
+import workspace
+import progress
 
 from pprint import pprint
 
@@ -33,9 +36,29 @@ def check_args(args) -> bool:
         return False
     if not playlist.check_arguments(args):
         return False
+    if not library.check_arguments(args):
+        return False
+    if not workspace.check_arguments(args):
+        return False
+    if not progress.check_arguments(args):
+        return False
+
+    if download.is_remote_file(args.media_file_path) and args.timestamps_file_path in ['stdin', 'chapters'] and args.dest is None:
+        print('With a remote file and reading timestamps from stdin or chapters, the --dest argument is required.')
+        return False
+
+    if not download.is_remote_file(args.media_file_path) and args.timestamps_file_path == 'chapters':
+        info_json_path = timestamps.get_info_json_path(args.media_file_path)
+        if not info_json_path.exists():
+            print('Using chapters of a local file requires the yt-dlp info JSON {}.'.format(info_json_path))
+            return False
+
+    if args.batch and (not download.is_remote_file(args.media_file_path) or args.timestamps_file_path != 'chapters'):
+        print('--batch requires a playlist or channel URL and "chapters" as timestamps.')
+        return False
 
-    if download.is_remote_file(args.media_file_path) and args.timestamps_file_path == 'stdin' and args.dest is None:
-        print('With a remote file and reading timestamps from stdin, the --dest argument is required.')
+    if args.batch_concurrent_downloads < 1:
+        print('--batch-concurrent-downloads must be at least 1.')
         return False
 
     if not download.is_remote_file(args.media_file_path) and args.use_thumbnail:
@@ -64,7 +87,9 @@ def parse_args(args: list[str]):
         help='Path to a file containing the timestamps of the individual tracks. '
         'Each timestamp marks the start of a track. '
         'If multiple timestamps are present in a line, the first one is chosen. '
-        'Common formats like hh:mm:ss, mm:ss, hh.mm.ss. and mm.ss are supported. '
+        'Common formats like hh:mm:ss, mm:ss, hh.mm.ss. and mm.ss are supported, with colons also with milliseconds like mm:ss.mmm. '
+        'CUE sheets (.cue) and yt-dlp info JSON files (.info.json) are supported as well, they can also provide the titles and artists. '
+        'If "chapters" is specified, take the chapters or timestamps in the description from the yt-dlp info JSON of the media. '
         'If "stdin" is specified (the default) take the timestamps from stdin. '
         'If providing interactively via stdin, terminate the timestmaps with 2 empty lines or with EOF (CTRL+D).')
     parser.add_argument('--dest', type=str, help='Destination directory for the output. '
@@ -72,6 +97,11 @@ def parse_args(args: list[str]):
         'By default the directory is either the directory of the media file (if local) or the directory of the timestamp file. '
         'If the media file is remote and timestamps are passed via stdin, this option is required.')
 
+    parser.add_argument('--batch', action=argparse.BooleanOptionalAction, default=False, help='Treat the URL as playlist or channel and process all of its entries. '
+        'The timestamps are taken from the chapters or descriptions, so "chapters" must be given as timestamps. Requires --dest.')
+    parser.add_argument('--batch-concurrent-downloads', type=int, default=2, help='Number of parallel downloads in batch mode, finished downloads are processed while the others continue, default = 2.')
+    parser.add_argument('--batch-archive', type=str, help='File recording the processed entries in batch mode, entries found in it are skipped. Uses the same format as the yt-dlp download archive.')
+
     parser.add_argument('--use-thumbnail', action=argparse.BooleanOptionalAction, help='Download the thumbnail from the media URL and use it when tagging. By default fetch the thumbnail when downloading a remote media file.')
     parser.add_argument('--audio-format', type=str, help='Audio format to use. All split files will be of the same type. Any audio format supported by yt-dlp can be used. Recommended: "flac" or "mp3". Default is "mp3"')
     parser.add_argument('--thumbnail-file-path', type=str, help='Path to the thumbnail to use, implies --use-thumbnail.')
@@ -79,64 +109,68 @@ def parse_args(args: list[str]):
     parser.add_argument('--split-file-pattern', type=str, default=r'fragment_%n', help='File name pattern used for fragments after splitting. The fragments are generated in the destination folder. '
         r'Following replacements are supported: %%n - fragment number (from 0), %%f - media filename without extension. '
         r'The pattern must include at least one %%n. The default is "fragment_%%n". The extension is appended automatically.')
-    parser.add_argument('--split-num-threads', type=int, default=0, help='How many splits to perform in parralel. The default value of 0 means to use the same number as cpu cores.')
-    parser.add_argument('--split-start-offset', type=int, default=1, help='Offset from the start timestamp to actually start the fragment, supports positive and negative values, default = 1.')
-    parser.add_argument('--split-fade-in', type=int, default=2, help='Over how many seconds to fade in the sound after the start timestamp, default = 2.')
-    parser.add_argument('--split-end-offset', type=int, default=-1, help='Offset from the end timestamp to actually end the fragment, supports positive and negative values, default = -1.')
-    parser.add_argument('--split-fade-out', type=int, default=3, help='Over how many seconds to fade out the sound before the end timestamp, default = 3.')
-
-    parser.add_argument('--recognize-num-threads', type=int, default=8, help='Number of parallel songrec calls, default = 8.')
+    parser.add_argument('--split-output-formats', type=str, help='Comma separated list of formats to create for each track, e.g. "flac,mp3". '
+        'All formats are created from a single decode of the media. The first format is used for recognition and the main playlist. '
+        'By default only the format of the media file is created.')
+    parser.add_argument('--split-num-threads', type=int, default=0, help='How many splits to perform in parralel. '
+        'The default value of 0 picks the number based on the available CPUs (respecting container limits), memory and whether the split needs to re-encode.')
+    parser.add_argument('--split-adaptive', action=argparse.BooleanOptionalAction, default=True, help='With --split-num-threads 0, adjust the number of parallel splits while running based on the measured throughput and iowait, default = true.')
+    parser.add_argument('--split-start-offset', type=float, help='Offset from the start timestamp to actually start the fragment, supports positive and negative values, default = 1 (0 for sub-second accurate timestamps).')
+    parser.add_argument('--split-fade-in', type=float, help='Over how many seconds to fade in the sound after the start timestamp, default = 2 (0.5 for sub-second accurate timestamps).')
+    parser.add_argument('--split-end-offset', type=float, help='Offset from the end timestamp to actually end the fragment, supports positive and negative values, default = -1 (0 for sub-second accurate timestamps).')
+    parser.add_argument('--split-fade-out', type=float, help='Over how many seconds to fade out the sound before the end timestamp, default = 3 (1 for sub-second accurate timestamps).')
+
+    parser.add_argument('--recognize-num-threads', type=int, default=8, help='Number of parallel songrec calls to start with, default = 8.')
+    parser.add_argument('--recognize-max-threads', type=int, default=16, help='Upper limit for the number of parallel songrec calls when adapting, default = 16.')
+    parser.add_argument('--recognize-adaptive', action=argparse.BooleanOptionalAction, default=True, help='Adapt the number of parallel songrec calls to errors and response times: '
+        'halve it on failures or slow responses, slowly increase it again on success, default = true.')
+    parser.add_argument('--recognize-rate-limit', type=float, default=0, help='Maximum number of songrec calls per second, the default value of 0 means no limit.')
+    parser.add_argument('--recognize-rate-limit-file', type=str, help='State file for the rate limit. All jobs using the same file share the --recognize-rate-limit. Requires --recognize-rate-limit.')
+    parser.add_argument('--recognize-max-retries', type=int, default=3, help='How often a failed songrec call is retried before giving up, default = 3.')
+    parser.add_argument('--recognize-skip-known', action=argparse.BooleanOptionalAction, default=True, help='Do not call songrec for tracks whose title and artist are known from the track list (CUE sheet or chapters), default = true.')
+    parser.add_argument('--recognize-songrec-path', type=str, default='songrec', help='Path to the songrec executable, default = songrec.')
+
+    parser.add_argument('--workspace', action=argparse.BooleanOptionalAction, default=False, help='Decode the media once into a temporary raw 16 bit PCM file that is shared by splitting and recognition, '
+        'instead of decoding it again for every fragment and recheck. Not used for straight copies. default = false.')
+    parser.add_argument('--workspace-max-size', type=int, default=4096, help='Maximum size of the workspace in MiB. If the decoded media would be larger, no workspace is used. default = 4096.')
+    parser.add_argument('--workspace-dir', type=str, help='Directory to create the workspace in, default is the system temporary directory.')
+
+    parser.add_argument('--progress-output', type=str, help='Write machine readable progress events as JSON lines to this target: '
+        'fd:<number> for an open file descriptor, tcp:<host>:<port>, unix:<socket path> or a file path (appended). '
+        'Events are stage_start, item_done (with throughput and ETA), stage_end and heartbeat.')
+    parser.add_argument('--progress-heartbeat', type=float, default=10, help='Seconds between heartbeat events, 0 disables them, default = 10.')
 
     parser.add_argument('--rename-name-pattern', type=str, default=r'%N - %t', help=r'The file name pattern used when renaming tracks. Following placeholders are supported: %%t - title, %%a - artist, %%n - track number, %N - track number, leading zero(s), %%l - aLbum, %%m - media file name.'
         r'The extension is appended automatically, default = %%N - %%t')
     parser.add_argument('--rename-sanitize-file-names', action=argparse.BooleanOptionalAction, default=True, help='Remove more "special" chars from file names to make them more compatible. Unsafe chars are always removed. default = true.')
 
+    parser.add_argument('--library-path', type=str, help='SQLite database indexing all recognized tracks over all processed media. It is created if it does not exist.')
+    parser.add_argument('--library-duplicates', type=str, choices=library.DUPLICATE_MODES, default='keep', help='What to do with tracks already in the library: '
+        'keep - keep the new copy, skip - delete the new copy, hardlink - replace the new copy with a hardlink to the library copy, '
+        'best - like hardlink, but if the new copy has a better quality it replaces the library copies instead. '
+        'Hardlinked copies share their tags. Requires --library-path, default = keep.')
+
     parser.add_argument('--playlist-create-same-folder', action=argparse.BooleanOptionalAction, default=True, help='Create a playlist in the same folder as the media files, default = true.')
     parser.add_argument('--playlist-create-parent-folder', action=argparse.BooleanOptionalAction, default=False, help='Create a playlist in parent folder of the folder holding the media files, default = false.')
+    parser.add_argument('--playlist-formats', type=str, default='m3u', help='Comma separated list of playlist formats to create: m3u, m3u8 (UTF-8), xspf and cue. '
+        'The CUE sheet describes the tracks in the original media and is placed next to it, an existing CUE sheet is not overwritten. Default = m3u.')
+    parser.add_argument('--playlist-master', type=str, help='Path to a .m3u or .m3u8 playlist collecting the tracks of all processed media. '
+        'The tracks are appended, the playlist is created if it does not exist.')
 
     args = parser.parse_args(args[1:])
     return args
 
 
-@logger.catch
-def main(args: list[str]) -> int:
-    args = parse_args(args)
-    logger.trace('Got arguments: {}', args)
-
-    if not check_args(args):
-        logger.debug('Arguments failed check_args: {}.', args)
+# Processes a single media file: split, recognize, rename, tag and create the playlists.
+# tracklist None means to take it from the chapters in the info JSON.
+def process_media(args, media_file_path: str, thumbnail_file_path: str or None, info_json_path: str, tracklist, destination_directory, use_thumbnail: bool) -> int:
+    if tracklist is None:
+        tracklist = timestamps.get_tracklist(str(info_json_path))
+        logger.trace('Got {} timestamps from chapters.', len(tracklist))
+    if len(tracklist) == 0:
+        logger.error('No timestamps found for {}.', media_file_path)
         return 1
 
-    media_file_path = args.media_file_path
-    timestamps_file_path = args.timestamps_file_path
-    destination_directory = args.dest
-    use_thumbnail = args.use_thumbnail
-    if destination_directory is None:
-        if not download.is_remote_file(media_file_path):
-            destination_directory = Path(media_file_path).parent
-        elif timestamps_file_path != 'stdin':
-            destination_directory = Path(timestamps_file_path).parent
-    if destination_directory is None:
-        raise ValueError('Unreachable: check_args() should have prevent this case (remote file and stdin as timestamps, but no --dest).')
-
-    if download.is_remote_file(media_file_path) and use_thumbnail is None:
-        use_thumbnail = True
-
-    audio_format = args.audio_format
-    if download.is_remote_file(media_file_path) and audio_format is None:
-        audio_format = "mp3"
-
-    timestamps_list = timestamps.get_timestamps(timestamps_file_path)
-    logger.trace('Got {} timestamps.', len(timestamps_list))
-
-    # create destination directory
-    os.makedirs(destination_directory, exist_ok=True)
-
-    if download.is_remote_file(media_file_path):
-        logger.trace('Attempting download of {} as {}.', media_file_path, audio_format)
-        media_file_path, thumbnail_file_path = download.download(media_file_path, Path(destination_directory), audio_format, use_thumbnail)
-        logger.trace('Download complete. Destination {}, thumbnail at {}.', media_file_path, thumbnail_file_path)
-
     if args.thumbnail_file_path is not None:
         use_thumbnail = True
         thumbnail_file_path = args.thumbnail_file_path
@@ -180,24 +214,172 @@ def main(args: list[str]) -> int:
     else:
         thumbnail_file_path = None
 
-    split_config = split.get_config_from_arguments(args)
-    splitted_files = split.split_files(media_file_path, timestamps_list, media_directory, split_config)
-    logger.debug('Split into {} files.', len(splitted_files))
-
-    recognize_num_threads = args.recognize_num_threads
-    tracks = recognize.recognize_tracks(splitted_files, recognize_num_threads)
+    # keep the downloaded metadata next to the media
+    if download.is_remote_file(args.media_file_path) and Path(info_json_path).exists():
+        os.replace(info_json_path, media_directory.joinpath(Path(info_json_path).name))
+
+    timestamps_list = [entry.start for entry in tracklist]
+    split_config = split.get_config_from_arguments(args, timestamps.is_precise(tracklist))
+    # a single probe of the media gives the end of the last track, all other durations are known from the timestamps
+    media_duration = split.probe_media_duration(str(media_file_path))
+    recognize_config = recognize.get_config_from_arguments(args)
+    media_workspace = workspace.get_workspace_from_arguments(args, str(media_file_path), media_duration)
+    try:
+        split_config.workspace = media_workspace
+        recognize_config.workspace = media_workspace
+        progress.stage_start('split', len(timestamps_list))
+        splitted_files = split.split_files_indexed(media_file_path, timestamps_list, media_directory, split_config, media_duration, 'split')
+        progress.stage_end('split')
+        logger.debug('Split into {} files.', len(splitted_files))
+
+        entries = [tracklist[index] for index, _, _ in splitted_files]
+        ranges = [split.get_fragment_range(timestamps_list, index, split_config) for index, _, _ in splitted_files]
+        # only the primary format is recognized, the result applies to all formats
+        progress.stage_start('recognize', len(splitted_files))
+        tracks = recognize.recognize_tracks([paths[0] for _, paths, _ in splitted_files], recognize_config, entries, ranges)
+        progress.stage_end('recognize')
+    finally:
+        if media_workspace is not None:
+            media_workspace.close()
+    for track, (index, paths, duration) in zip(tracks, splitted_files):
+        track.variant_paths = paths[1:]
+        track.start = timestamps_list[index]
+        track.duration = duration
 
     rename_name_pattern = args.rename_name_pattern
     restricted_file_names = args.rename_sanitize_file_names
-    tracks = rename.rename_tracks(tracks, media_file_path, rename_name_pattern, restricted_file_names)
+    track_library = library.get_library_from_arguments(args)
+    if track_library is not None:
+        tracks = library.deduplicate_tracks(tracks, track_library, args.library_duplicates)
 
-    tag.tag_tracks(tracks, thumbnail_file_path)
+    progress.stage_start('rename', len(tracks))
+    tracks = rename.rename_tracks(tracks, media_file_path, rename_name_pattern, restricted_file_names, track_library)
+    progress.stage_end('rename')
+
+    progress.stage_start('tag', len(tracks))
+    tag.tag_tracks(tracks, thumbnail_file_path, track_library)
+    progress.stage_end('tag')
+
+    if track_library is not None:
+        library.replace_library_copies(tracks, track_library)
+        track_library.close()
 
     playlist_same_folder = args.playlist_create_same_folder
     playlist_paremt_folder = args.playlist_create_parent_folder
-    playlist.create_playlist(tracks, playlist_same_folder, playlist_paremt_folder)
-    
+    playlist_formats = playlist.parse_playlist_formats(args.playlist_formats)
+    progress.stage_start('playlist')
+    playlist.create_playlist(tracks, playlist_same_folder, playlist_paremt_folder, playlist_formats, str(media_file_path))
+    if args.playlist_master is not None:
+        playlist.append_master_playlist(tracks, args.playlist_master)
+    progress.stage_end('playlist')
+
     return 0
 
+
+# Processes all new entries of a playlist or channel.
+# Downloads run in the background while finished ones are processed, entries in the archive are skipped.
+def process_batch(args, destination_directory, audio_format: str, use_thumbnail: bool) -> int:
+    # the downloads run in the background, they must not depend on the working directory
+    destination_directory = Path(destination_directory).resolve()
+    archive = download.read_archive(args.batch_archive)
+    entries = download.list_entries(args.media_file_path)
+    new_entries = [entry for entry in entries if download.get_archive_key(entry) not in archive]
+    logger.info('{} of {} entries of {} are new.', len(new_entries), len(entries), args.media_file_path)
+
+    indices = {download.get_archive_key(entry): i for i, entry in enumerate(new_entries)}
+    failures = 0
+    progress.stage_start('download', len(new_entries))
+    for entry, result in download.download_entries(new_entries, Path(destination_directory), audio_format, use_thumbnail, args.batch_concurrent_downloads):
+        index = indices[download.get_archive_key(entry)]
+        if isinstance(result, Exception):
+            logger.error('Download of {} failed: {}', entry['url'], result)
+            progress.item_done('download', index, ok=False)
+            failures += 1
+            continue
+        progress.item_done('download', index)
+        media_file_path, thumbnail_file_path, info_json_path = result
+        logger.debug('Downloaded {} to {}.', entry['url'], media_file_path)
+
+        tracklist = timestamps.get_tracklist(str(info_json_path))
+        if len(tracklist) == 0:
+            # nothing to split, keep the media for manual processing, but do not download it again
+            logger.warning('No chapters or timestamps in the description of {}, not processing {}.', entry['url'], media_file_path)
+            download.add_to_archive(args.batch_archive, entry)
+            continue
+
+        try:
+            ret = process_media(args, media_file_path, thumbnail_file_path, info_json_path, tracklist, destination_directory, use_thumbnail)
+        except Exception as e:
+            logger.exception('Processing {} failed: {}', media_file_path, e)
+            ret = 1
+        if ret == 0:
+            download.add_to_archive(args.batch_archive, entry)
+        else:
+            failures += 1
+    progress.stage_end('download')
+
+    logger.info('Processed {} entries, {} failed.', len(new_entries) - failures, failures)
+    return 0 if failures == 0 else 1
+
+
+@logger.catch
+def main(args: list[str]) -> int:
+    args = parse_args(args)
+    logger.trace('Got arguments: {}', args)
+
+    if not check_args(args):
+        logger.debug('Arguments failed check_args: {}.', args)
+        return 1
+
+    progress.configure_from_arguments(args)
+
+    media_file_path = args.media_file_path
+    timestamps_file_path = args.timestamps_file_path
+    destination_directory = args.dest
+    use_thumbnail = args.use_thumbnail
+    if destination_directory is None:
+        if not download.is_remote_file(media_file_path):
+            destination_directory = Path(media_file_path).parent
+        elif timestamps_file_path not in ['stdin', 'chapters']:
+            destination_directory = Path(timestamps_file_path).parent
+    if destination_directory is None:
+        raise ValueError('Unreachable: check_args() should have prevent this case (remote file and stdin as timestamps, but no --dest).')
+
+    if download.is_remote_file(media_file_path) and use_thumbnail is None:
+        use_thumbnail = True
+
+    audio_format = args.audio_format
+    if download.is_remote_file(media_file_path) and audio_format is None:
+        audio_format = "mp3"
+
+    # create destination directory
+    os.makedirs(destination_directory, exist_ok=True)
+
+    if args.batch:
+        ret = process_batch(args, destination_directory, audio_format, use_thumbnail)
+        progress.close()
+        return ret
+
+    # chapters are only known after the download
+    tracklist = None
+    if timestamps_file_path != 'chapters':
+        tracklist = timestamps.get_tracklist(timestamps_file_path)
+        logger.trace('Got {} timestamps.', len(tracklist))
+
+    if download.is_remote_file(media_file_path):
+        logger.trace('Attempting download of {} as {}.', media_file_path, audio_format)
+        progress.stage_start('download')
+        media_file_path, thumbnail_file_path, info_json_path = download.download(media_file_path, Path(destination_directory), audio_format, use_thumbnail)
+        progress.stage_end('download')
+        logger.trace('Download complete. Destination {}, thumbnail at {}, info JSON at {}.', media_file_path, thumbnail_file_path, info_json_path)
+    else:
+        thumbnail_file_path = None
+        info_json_path = timestamps.get_info_json_path(media_file_path)
+
+    ret = process_media(args, media_file_path, thumbnail_file_path, info_json_path, tracklist, destination_directory, use_thumbnail)
+
+    progress.close()
+    return ret
+
 if __name__ == '__main__':
     exit(main(sys.argv))
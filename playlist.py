@@ -3,34 +3,159 @@
 from loguru import logger
 from typing import List
 from pathlib import Path
+from urllib.parse import quote
+from xml.sax.saxutils import escape
+import os
 
 from recognize import Track
+from timestamps import CUE_FRAMES_PER_SECOND
+
+PLAYLIST_FORMATS = ['m3u', 'm3u8', 'xspf', 'cue']
+
 
 def check_arguments(args) -> bool:
+    for playlist_format in parse_playlist_formats(args.playlist_formats):
+        if playlist_format not in PLAYLIST_FORMATS:
+            print('Unsupported playlist format {}, supported are: {}.'.format(playlist_format, ', '.join(PLAYLIST_FORMATS)))
+            return False
+    if args.playlist_master is not None and Path(args.playlist_master).suffix.lower() not in ['.m3u', '.m3u8']:
+        print('--playlist-master must be a .m3u or .m3u8 file.')
+        return False
     return True
 
 
-def write_m3u_playlist(tracks: List[Track], file_prefix: str, destination_handle) -> None:
+# "m3u,xspf" -> ['m3u', 'xspf']
+def parse_playlist_formats(playlist_formats: str) -> List[str]:
+    return [f.strip().lstrip('.').lower() for f in playlist_formats.split(',') if len(f.strip()) > 0]
+
+
+def get_extinf(track: Track) -> str:
+    # EXTINF contains the length in seconds (-1 means unknown), the artist and the title
+    duration = round(track.duration) if track.duration is not None else -1
+    return '#EXTINF:{},{} - {}\n'.format(duration, track.artist, track.title)
+
+
+# variant selects the output format, 0 is the primary one
+def write_m3u_playlist(tracks: List[Track], file_prefix: str, destination_handle, variant: int = 0) -> None:
     destination_handle.write('#EXTM3U\n')
     for track in tracks:
-        # EXTINF contains the length (-1 means ignore), the artist and the title
-        destination_handle.write('#EXTINF:-1,{} - {}\n'.format(track.artist, track.title))
-        file_name = Path(track.file_path).name
+        destination_handle.write(get_extinf(track))
+        file_name = Path(track.all_file_paths()[variant]).name
         destination_handle.write('{}{}\n'.format(file_prefix, file_name))
 
 
-def create_playlist(tracks: List[Track], same_folder: bool, parent_folder: bool) -> None:
-    if not same_folder and not parent_folder:
+def write_xspf_playlist(tracks: List[Track], file_prefix: str, destination_handle, variant: int = 0) -> None:
+    destination_handle.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+    destination_handle.write('<playlist version="1" xmlns="http://xspf.org/ns/0/">\n')
+    destination_handle.write('  <trackList>\n')
+    for track in tracks:
+        file_name = Path(track.all_file_paths()[variant]).name
+        destination_handle.write('    <track>\n')
+        # locations are URIs, relative ones are resolved against the playlist
+        destination_handle.write('      <location>{}</location>\n'.format(escape(quote(file_prefix + file_name))))
+        for element, value in [('title', track.title), ('creator', track.artist), ('album', track.album)]:
+            if value is not None:
+                destination_handle.write('      <{0}>{1}</{0}>\n'.format(element, escape(value)))
+        destination_handle.write('      <trackNum>{}</trackNum>\n'.format(track.position + 1))
+        if track.duration is not None:
+            destination_handle.write('      <duration>{}</duration>\n'.format(round(track.duration * 1000)))
+        destination_handle.write('    </track>\n')
+    destination_handle.write('  </trackList>\n')
+    destination_handle.write('</playlist>\n')
+
+
+def format_cue_time(seconds: float) -> str:
+    frames = round(seconds * CUE_FRAMES_PER_SECOND)
+    return '{:02}:{:02}:{:02}'.format(frames // (60 * CUE_FRAMES_PER_SECOND), frames // CUE_FRAMES_PER_SECOND % 60, frames % CUE_FRAMES_PER_SECOND)
+
+
+def cue_quote(s: str or None, default: str) -> str:
+    s = default if s is None else s
+    return '"{}"'.format(s.replace('"', '\''))
+
+
+# CUE sheet for the original media, describing where each track starts
+def write_cue_sheet(tracks: List[Track], media_file_path: str, destination_handle) -> None:
+    file_type = 'MP3' if Path(media_file_path).suffix.lower() == '.mp3' else 'WAVE'
+    destination_handle.write('TITLE {}\n'.format(cue_quote(Path(media_file_path).stem, '')))
+    destination_handle.write('FILE {} {}\n'.format(cue_quote(Path(media_file_path).name, ''), file_type))
+    for number, track in enumerate(tracks, 1):
+        destination_handle.write('  TRACK {:02} AUDIO\n'.format(number))
+        destination_handle.write('    TITLE {}\n'.format(cue_quote(track.title, 'Unknown Title')))
+        destination_handle.write('    PERFORMER {}\n'.format(cue_quote(track.artist, 'Unknown Artist')))
+        destination_handle.write('    INDEX 01 {}\n'.format(format_cue_time(track.start)))
+
+
+def write_playlist(tracks: List[Track], file_prefix: str, playlist_path: Path, playlist_format: str, variant: int) -> None:
+    logger.trace('Writing {} playlist {}.', playlist_format, playlist_path)
+    if playlist_format == 'm3u':
+        with open(playlist_path, 'w') as f:
+            write_m3u_playlist(tracks, file_prefix, f, variant)
+    elif playlist_format == 'm3u8':
+        with open(playlist_path, 'w', encoding='utf-8') as f:
+            write_m3u_playlist(tracks, file_prefix, f, variant)
+    elif playlist_format == 'xspf':
+        with open(playlist_path, 'w', encoding='utf-8') as f:
+            write_xspf_playlist(tracks, file_prefix, f, variant)
+    else:
+        raise ValueError('Unreachable: unsupported playlist format {}.'.format(playlist_format))
+
+
+# Creates one playlist per output format and playlist format,
+# the additional output formats get the extension in the name, e.g. mix.mp3.m3u.
+# The CUE sheet describes the media file, so it is only created once next to it.
+def create_playlist(tracks: List[Track], same_folder: bool, parent_folder: bool,
+                    playlist_formats: List[str] or None = None, media_file_path: str or None = None) -> None:
+    playlist_formats = ['m3u'] if playlist_formats is None else playlist_formats
+    if len(tracks) == 0:
+        logger.warning('No tracks, not creating a playlist.')
         return
 
     same_folder_path = Path(tracks[0].file_path).parent
     same_folder_name = same_folder_path.name
     parent_folder_path = same_folder_path.parent
 
-    if same_folder:
-        with open(same_folder_path.joinpath(same_folder_name + '.m3u'), 'w') as f:
-            write_m3u_playlist(tracks, '', f)
+    if 'cue' in playlist_formats and media_file_path is not None:
+        cue_path = Path(media_file_path).with_suffix('.cue')
+        # this might be the CUE sheet the track list came from
+        if cue_path.exists():
+            logger.info('Not overwriting existing CUE sheet {}.', cue_path)
+        elif any(track.start is None for track in tracks):
+            logger.warning('Start of some tracks unknown, not creating CUE sheet {}.', cue_path)
+        else:
+            with open(cue_path, 'w', encoding='utf-8') as f:
+                write_cue_sheet(tracks, media_file_path, f)
+
+    if not same_folder and not parent_folder:
+        return
+
+    for variant, file_path in enumerate(tracks[0].all_file_paths()):
+        for playlist_format in playlist_formats:
+            if playlist_format == 'cue':
+                continue
+            playlist_name = same_folder_name + '.' + playlist_format
+            if variant > 0:
+                playlist_name = same_folder_name + Path(file_path).suffix + '.' + playlist_format
+
+            if same_folder:
+                write_playlist(tracks, '', same_folder_path.joinpath(playlist_name), playlist_format, variant)
+
+            if parent_folder:
+                write_playlist(tracks, same_folder_name + '/', parent_folder_path.joinpath(playlist_name), playlist_format, variant)
+
 
-    if parent_folder:
-        with open(parent_folder_path.joinpath(same_folder_name + '.m3u'), 'w') as f:
-            write_m3u_playlist(tracks, same_folder_name + '/', f)
+# Appends the tracks to a playlist covering many media files.
+# Only the new entries are written, so this stays cheap no matter how many media files were processed before.
+def append_master_playlist(tracks: List[Track], master_playlist_path: str, variant: int = 0) -> None:
+    master_playlist_path = Path(master_playlist_path)
+    encoding = 'utf-8' if master_playlist_path.suffix.lower() == '.m3u8' else None
+    is_new = not master_playlist_path.exists() or master_playlist_path.stat().st_size == 0
+    with open(master_playlist_path, 'a', encoding=encoding) as f:
+        if is_new:
+            f.write('#EXTM3U\n')
+        for track in tracks:
+            f.write(get_extinf(track))
+            # relative to the master playlist, with forward slashes like the other playlists
+            relative_path = os.path.relpath(track.all_file_paths()[variant], master_playlist_path.parent)
+            f.write('{}\n'.format(Path(relative_path).as_posix()))
+    logger.debug('Appended {} tracks to master playlist {}.', len(tracks), master_playlist_path)
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+from loguru import logger
+import json
+import os
+import socket
+import threading
+import time
+
+# Machine readable progress as JSON lines, for orchestration tools.
+# Each line is one event with at least "event" and "time" (unix timestamp):
+# - stage_start: a stage (download, split, recognize, rename, tag, playlist) starts, with the number of items if known
+# - item_done: an item (fragment) of a stage is done, with throughput and ETA of the stage
+# - stage_end: a stage is done
+# - heartbeat: sent regularly while running, allows to detect stalls by comparing last_progress to time,
+#   stage is the innermost running stage, active_stages all running ones, e.g. the download of a batch around the split of one video
+# Without a configured output all functions do nothing.
+
+
+class StageProgress:
+    def __init__(self, name: str, total: int or None):
+        self.name = name
+        self.total = total
+        self.completed = 0
+        self.failed = 0
+        self.weight = 0.0
+        self.start_time = time.time()
+
+    def elapsed(self) -> float:
+        return time.time() - self.start_time
+
+    # items per second and the estimated seconds until the stage is done, based on the completed items
+    def throughput_and_eta(self):
+        elapsed = self.elapsed()
+        done = self.completed + self.failed
+        if done == 0 or elapsed <= 0:
+            return None, None
+        throughput = done / elapsed
+        eta = None
+        if self.total is not None:
+            eta = max(0, self.total - done) / throughput
+        return throughput, eta
+
+
+class ProgressStream:
+    def __init__(self, handle, heartbeat_interval: float):
+        self.handle = handle
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.current_stage = None
+        # running stages, the innermost last
+        self.active_stages = []
+        self.last_progress = time.time()
+        self.stop_event = threading.Event()
+        self.heartbeat_thread = None
+        if heartbeat_interval > 0:
+            self.heartbeat_thread = threading.Thread(target=self._heartbeat, args=(heartbeat_interval,), daemon=True)
+            self.heartbeat_thread.start()
+
+    def emit(self, event: str, **fields) -> None:
+        fields['event'] = event
+        fields['time'] = time.time()
+        line = json.dumps(fields) + '\n'
+        with self.lock:
+            try:
+                self.handle.write(line)
+                self.handle.flush()
+            except (OSError, ValueError) as e:
+                # the consumer going away must not stop the processing
+                logger.warning('Unable to write progress event: {}', e)
+
+    def _heartbeat(self, interval: float) -> None:
+        while not self.stop_event.wait(interval):
+            with self.lock:
+                fields = {'stage': self.current_stage, 'active_stages': list(self.active_stages), 'last_progress': self.last_progress}
+                stage = self.stages.get(self.current_stage)
+                if stage is not None:
+                    fields.update(stage_fields(stage))
+            self.emit('heartbeat', **fields)
+
+    def close(self) -> None:
+        self.stop_event.set()
+        if self.heartbeat_thread is not None:
+            self.heartbeat_thread.join()
+        with self.lock:
+            self.handle.close()
+
+
+def stage_fields(stage: StageProgress) -> dict:
+    throughput, eta = stage.throughput_and_eta()
+    fields = {
+        'completed': stage.completed,
+        'failed': stage.failed,
+        'total': stage.total,
+        'elapsed': stage.elapsed(),
+        'throughput': throughput,
+        'eta': eta,
+    }
+    if stage.weight > 0 and stage.elapsed() > 0:
+        # e.g. seconds of audio per second
+        fields['weight_throughput'] = stage.weight / stage.elapsed()
+    return fields
+
+
+stream = None
+
+
+# target is one of
+# - fd:<number> - an already open file descriptor, e.g. fd:3
+# - tcp:<host>:<port> - a TCP connection
+# - unix:<path> - a unix domain socket
+# - any other value is used as file path, events are appended
+def open_target(target: str):
+    if target.startswith('fd:'):
+        return os.fdopen(int(target[3:]), 'w', buffering=1)
+    if target.startswith('tcp:'):
+        host, port = target[4:].rsplit(':', 1)
+        return socket.create_connection((host, int(port))).makefile('w', buffering=1)
+    if target.startswith('unix:'):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(target[5:])
+        return sock.makefile('w', buffering=1)
+    return open(target, 'a', buffering=1)
+
+
+def check_arguments(args) -> bool:
+    if args.progress_output is None:
+        return True
+    target = args.progress_output
+    if target.startswith('fd:') and not target[3:].isdigit():
+        print('--progress-output fd:<number> needs a file descriptor number.')
+        return False
+    if target.startswith('tcp:') and (':' not in target[4:] or not target.rsplit(':', 1)[1].isdigit()):
+        print('--progress-output tcp:<host>:<port> needs a host and a port.')
+        return False
+    if args.progress_heartbeat < 0:
+        print('--progress-heartbeat must not be negative.')
+        return False
+    return True
+
+
+def configure_from_arguments(args) -> None:
+    global stream
+    if args.progress_output is None:
+        return
+    stream = ProgressStream(open_target(args.progress_output), args.progress_heartbeat)
+    logger.debug('Writing progress events to {}.', args.progress_output)
+
+
+def close() -> None:
+    global stream
+    if stream is not None:
+        stream.close()
+        stream = None
+
+
+def stage_start(name: str, total: int or None = None) -> None:
+    if stream is None:
+        return
+    with stream.lock:
+        stream.stages[name] = StageProgress(name, total)
+        if name in stream.active_stages:
+            stream.active_stages.remove(name)
+        stream.active_stages.append(name)
+        stream.current_stage = name
+        stream.last_progress = time.time()
+    stream.emit('stage_start', stage=name, total=total)
+
+
+# weight is e.g. the seconds of audio of the item, used for weight_throughput
+def item_done(stage_name: str, index: int, ok: bool = True, weight: float or None = None, **fields) -> None:
+    if stream is None:
+        return
+    with stream.lock:
+        stage = stream.stages.get(stage_name)
+        if stage is None:
+            stage = stream.stages[stage_name] = StageProgress(stage_name, None)
+        if ok:
+            stage.completed += 1
+        else:
+            stage.failed += 1
+        if weight is not None:
+            stage.weight += weight
+        stream.last_progress = time.time()
+        fields.update(stage_fields(stage))
+    stream.emit('item_done', stage=stage_name, index=index, ok=ok, **fields)
+
+
+def stage_end(name: str) -> None:
+    if stream is None:
+        return
+    with stream.lock:
+        stage = stream.stages.get(name)
+        fields = stage_fields(stage) if stage is not None else {}
+        stream.last_progress = time.time()
+        # back to the enclosing stage
+        if name in stream.active_stages:
+            stream.active_stages.remove(name)
+        stream.current_stage = stream.active_stages[-1] if len(stream.active_stages) > 0 else None
+    stream.emit('stage_end', stage=name, **fields)
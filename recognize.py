@@ -6,14 +6,57 @@ from typing import List, Tuple
 
 import subprocess
 import json
+import os
 import tempfile
-import multiprocessing
 from functools import partial
 
 import split
-
-
+import scheduler
+import progress
+from timestamps import TracklistEntry
+from workspace import PcmWorkspace
+
+# songrec only uses a few seconds around the middle of a file,
+# so an excerpt of that length from the middle of the fragment gives the same result
+EXCERPT_LENGTH = 20
+# the recheck tries one minute starting at 30 seconds
+RECHECK_START = 30
+RECHECK_END = 90
+
+
+# Wrapper class to hold all the config options
+class RecognizeConfig:
+    def __init__(self, args = None):
+        self.num_threads = args.recognize_num_threads if args is not None else 8
+        self.max_threads = args.recognize_max_threads if args is not None else 16
+        self.adaptive = args.recognize_adaptive if args is not None else True
+        self.rate_limit = args.recognize_rate_limit if args is not None else 0
+        self.rate_limit_file = args.recognize_rate_limit_file if args is not None else None
+        self.max_retries = args.recognize_max_retries if args is not None else 3
+        self.songrec_path = args.recognize_songrec_path if args is not None else 'songrec'
+        self.skip_known = args.recognize_skip_known if args is not None else True
+        # optional decoded media, see workspace.PcmWorkspace
+        self.workspace = None
+        if not self.adaptive:
+            self.max_threads = self.num_threads
+        self.max_threads = max(self.max_threads, self.num_threads)
+
+    def get_scheduler(self) -> scheduler.AdaptiveScheduler:
+        bucket = None
+        if self.rate_limit > 0:
+            # allow a burst of one call per thread
+            bucket = scheduler.TokenBucket(self.rate_limit, self.num_threads, self.rate_limit_file)
+        return scheduler.AdaptiveScheduler(self.num_threads, self.max_threads, bucket=bucket,
+            adaptive=self.adaptive, max_retries=self.max_retries)
+
+
+# Slotted, so large batches of tracks stay small and can be passed around cheaply, see to_tuple and from_tuple.
 class Track:
+    # all attributes, also the order used by to_tuple and from_tuple
+    FIELDS = ('artist', 'title', 'album', 'year', 'position', 'start', 'duration', 'file_path', 'variant_paths',
+              'fingerprint', 'had_recheck', 'library_duplicate', 'replaces_library_copy')
+    __slots__ = FIELDS
+
     def __init__(self):
         self.artist = None
         self.title = None
@@ -21,30 +64,81 @@ class Track:
         self.year = None
         # position in original media
         self.position = None
+        # start in the original media and duration in seconds, as cut by the split
+        self.start = None
+        self.duration = None
         # path on disc
         self.file_path = None
+        # paths of the same track in additional output formats
+        self.variant_paths = []
+        # Shazam key of the recognized song, None if unknown
+        self.fingerprint = None
 
         # internal statistics
         self.had_recheck = False
 
+        # set by library.deduplicate_tracks
+        # the file is a hardlink to a copy in the library and must not be tagged
+        self.library_duplicate = False
+        # the file is better than the copy in the library and replaces it after tagging
+        self.replaces_library_copy = False
+
     def __str__(self) -> str:
         return 'Track {} at {}: title {}, artist {}, album {}, year {}'.format(
             self.position, self.file_path, self.title, self.artist, self.album, self.year)
 
+    # the path of the primary format first, then the additional formats
+    def all_file_paths(self) -> List[str]:
+        return [self.file_path] + self.variant_paths
+
     def is_same_track(self, other) -> bool:
         return self.file_path == other.file_path and self.position == other.position
 
+    # plain tuple of all attributes, e.g. to store the track or send it to another process
+    def to_tuple(self) -> tuple:
+        return tuple(getattr(self, field) for field in Track.FIELDS)
+
+    @staticmethod
+    def from_tuple(values: tuple):
+        track = Track()
+        for field, value in zip(Track.FIELDS, values):
+            setattr(track, field, value)
+        # the list must not be shared with the tuple
+        track.variant_paths = list(track.variant_paths)
+        return track
+
+    # pickle uses the tuple as well, slotted objects have no __dict__
+    def __reduce__(self):
+        return Track.from_tuple, (self.to_tuple(),)
+
 
 def check_arguments(args) -> bool:
-    logger.trace('Checking songrec by executing songrec --version.')
-    subprocess.check_call(['songrec', '--version'], stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+    if args.recognize_num_threads < 1:
+        print('--recognize-num-threads must be at least 1.')
+        return False
+    if args.recognize_rate_limit < 0:
+        print('--recognize-rate-limit must not be negative.')
+        return False
+    if args.recognize_rate_limit_file is not None and args.recognize_rate_limit == 0:
+        print('--recognize-rate-limit-file requires --recognize-rate-limit.')
+        return False
+    if args.recognize_rate_limit_file is not None and scheduler.fcntl is None:
+        print('--recognize-rate-limit-file is not supported on this platform.')
+        return False
+
+    logger.trace('Checking songrec by executing {} --version.', args.recognize_songrec_path)
+    subprocess.check_call([args.recognize_songrec_path, '--version'], stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
     logger.trace('songrec is available.')
     return True
 
 
-def recognize_track(track_path: str, position: int) -> Track:
+def get_config_from_arguments(args) -> RecognizeConfig:
+    return RecognizeConfig(args)
+
+
+def recognize_track(track_path: str, position: int, songrec_path: str = 'songrec') -> Track:
     songrec_args = [
-        'songrec',
+        songrec_path,
         'audio-file-to-recognized-song',
         track_path
     ]
@@ -70,6 +164,7 @@ def recognize_track(track_path: str, position: int) -> Track:
 
     track.title = song_info['track']['title']
     track.artist = song_info['track']['subtitle']
+    track.fingerprint = song_info['track'].get('key')
 
     for section in song_info['track']['sections']:
         if 'metadata' in section:
@@ -83,8 +178,35 @@ def recognize_track(track_path: str, position: int) -> Track:
     return track
 
 
-def recognize_track_wrapper(arg_tuple: Tuple[int, str]) -> Track:
-    return recognize_track(arg_tuple[1], arg_tuple[0])
+# Recognizes the audio from start to end (seconds in the media) from the workspace
+# instead of decoding the fragment again. The excerpt is only written as a small WAV file because songrec needs a file.
+def recognize_excerpt(track_path: str, position: int, workspace: PcmWorkspace, start: float, end: float, songrec_path: str, name: str) -> Track:
+    excerpt_path = workspace.temp_path('{}_{}.wav'.format(name, position))
+    try:
+        workspace.write_wav(start, end, excerpt_path)
+        track = recognize_track(excerpt_path, position, songrec_path)
+    finally:
+        try:
+            os.remove(excerpt_path)
+        except FileNotFoundError:
+            pass
+    track.file_path = track_path
+    return track
+
+
+# ranges holds the start and end (None for the end of the media) of each fragment in the media,
+# needed to use the workspace
+def recognize_track_wrapper(config: RecognizeConfig, ranges: List[Tuple[float, float or None]] or None, arg_tuple: Tuple[int, str]) -> Track:
+    position, track_path = arg_tuple
+    if config.workspace is None or ranges is None:
+        return recognize_track(track_path, position, config.songrec_path)
+
+    start, end = ranges[position]
+    end = config.workspace.duration() if end is None else end
+    middle = (start + end) / 2
+    excerpt_start = max(start, middle - EXCERPT_LENGTH / 2)
+    excerpt_end = min(end, middle + EXCERPT_LENGTH / 2)
+    return recognize_excerpt(track_path, position, config.workspace, excerpt_start, excerpt_end, config.songrec_path, 'excerpt')
 
 
 # extracts a part from the track fruther from the start
@@ -115,11 +237,24 @@ def extract_part(track_path: str, tmpdir: str) -> str:
 
 
 # tries a different part of the track
-def recheck_track(track : Track) -> Track:
+# with a workspace and the range of the track in the media, the part is taken from there instead of splitting the track again
+def recheck_track(track : Track, songrec_path: str = 'songrec', workspace: PcmWorkspace or None = None,
+                  track_range: Tuple[float, float or None] or None = None) -> Track:
+    if workspace is not None and track_range is not None:
+        start, end = track_range
+        end = workspace.duration() if end is None else end
+        part_start = start + RECHECK_START if end - start > RECHECK_START else start
+        part_end = min(end, start + RECHECK_END)
+        logger.debug('Rechecking {} from the workspace ({} to {}).', track.file_path, part_start, part_end)
+        new_track = recognize_excerpt(track.file_path, track.position, workspace, part_start, part_end, songrec_path, 'recheck')
+        logger.debug('Re-recognized track: {}.', new_track)
+        new_track.had_recheck = True
+        return new_track
+
     with tempfile.TemporaryDirectory() as tmpdir:
         part_path = extract_part(track.file_path, tmpdir)
         logger.debug('Split part from {} to {}.', track.file_path, part_path)
-        new_track = recognize_track(part_path, track.position)
+        new_track = recognize_track(part_path, track.position, songrec_path)
         logger.debug('Re-recognized track: {}.', new_track)
         new_track.had_recheck = True
         new_track.file_path = track.file_path
@@ -127,28 +262,83 @@ def recheck_track(track : Track) -> Track:
         return new_track
 
 
-def recognize_tracks(track_paths: List[str], num_threads: int) -> List[Track]:
-    tracks = []
+def track_from_entry(entry: TracklistEntry, track_path: str, position: int) -> Track:
+    track = Track()
+    track.position = position
+    track.file_path = track_path
+    track.title = entry.title
+    track.artist = entry.artist
+    track.album = entry.album
+    return track
+
+
+# songrec decodes the whole fragment, so its latency grows with the length of the fragment.
+# Returns the cost of a lookup for the scheduler, the length of the fragment, or None if all lookups cost the same.
+def get_lookup_cost(config: RecognizeConfig, ranges: List[Tuple[float, float or None]] or None):
+    if config.workspace is not None or ranges is None:
+        # excerpts all have the same length
+        return None
+    durations = [end - start for start, end in ranges if end is not None]
+    # the length of the last fragment is unknown, assume an average one
+    average_duration = sum(durations) / len(durations) if len(durations) > 0 else 1.0
+    return lambda item: ranges[item[0]][1] - ranges[item[0]][0] if ranges[item[0]][1] is not None else average_duration
+
+
+# entries optionally holds the track list entry of each track, e.g. from a CUE sheet or chapters.
+# Tracks with a known title and artist are not looked up if config.skip_known is set.
+# ranges optionally holds the start and end of each track in the media, needed to use config.workspace.
+def recognize_tracks(track_paths: List[str], config: RecognizeConfig, entries: List[TracklistEntry or None] or None = None,
+                     ranges: List[Tuple[float, float or None]] or None = None) -> List[Track]:
+    tracks = [None] * len(track_paths)
     recognized = 0
     rechecked = 0
     recognized_after_recheck = 0
-    pool = multiprocessing.Pool(num_threads)
-    logger.trace('Starting recognize with {} threds.', num_threads)
-    tracks = pool.map(recognize_track_wrapper, enumerate(track_paths))
+
+    lookups = []
+    for i, track_path in enumerate(track_paths):
+        entry = entries[i] if entries is not None else None
+        if config.skip_known and entry is not None and entry.is_known():
+            tracks[i] = track_from_entry(entry, track_path, i)
+            progress.item_done('recognize', i, source='tracklist')
+            logger.trace('Using track list entry for {}: {}.', track_path, tracks[i])
+        else:
+            lookups.append((i, track_path))
+    logger.debug('{} of {} tracks known from the track list.', len(track_paths) - len(lookups), len(track_paths))
+
+    # songrec runs in its own process, threads are enough to drive it
+    track_scheduler = config.get_scheduler()
+    logger.trace('Starting recognize with {} threads (max {}, adaptive: {}).', config.num_threads, config.max_threads, config.adaptive)
+    on_done = lambda _, item, track: progress.item_done('recognize', item[0], ok=isinstance(track, Track),
+        recognized=isinstance(track, Track) and track.title is not None, source='songrec')
+    for track in track_scheduler.map(partial(recognize_track_wrapper, config, ranges), lookups, on_done, get_lookup_cost(config, ranges)):
+        tracks[track.position] = track
+
+    # the rechecks use the same scheduler, so they share the rate limit, the concurrency and the retries
+    rechecks = [(i, track) for i, track in enumerate(tracks) if track.title is None]
+    on_done = lambda _, item, track: progress.item_done('recheck', item[0], ok=isinstance(track, Track),
+        recognized=isinstance(track, Track) and track.title is not None)
+    recheck = lambda item: recheck_track(item[1], config.songrec_path, config.workspace, ranges[item[0]] if ranges is not None else None)
+    for (i, track), new_track in zip(rechecks, track_scheduler.map(recheck, rechecks, on_done, return_exceptions=True)):
+        if isinstance(new_track, Exception):
+            # keep the track unrecognized instead of failing the whole job
+            logger.warning('Recheck of {} failed: {}', track.file_path, new_track)
+            track.had_recheck = True
+        else:
+            tracks[i] = new_track
 
     for i, track in enumerate(tracks):
-        # for some reason we can not try recognize again inside the thread pool above
-        # slow workaround here (FIXME)
-        if track.title is None:
-            # modify the element in the list
-            tracks[i] = recheck_track(track)
-            track = tracks[i]
         if track.title is not None:
             recognized += 1
             if track.had_recheck:
                 recognized_after_recheck += 1
         if track.had_recheck:
             rechecked += 1
+        # fall back to whatever the track list knows
+        entry = entries[i] if entries is not None else None
+        if track.title is None and entry is not None and entry.title is not None:
+            tracks[i] = track_from_entry(entry, track.file_path, track.position)
+            tracks[i].had_recheck = track.had_recheck
+            logger.debug('Using track list entry for unrecognized track {}.', tracks[i])
 
     logger.debug('Recognized {} of {} tracks. Rechecked {} tracks, success on {} of them.',
         recognized, len(tracks), rechecked, recognized_after_recheck)
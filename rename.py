@@ -2,48 +2,150 @@
 
 from math import ceil, log10
 from loguru import logger
-from typing import List
+from typing import Dict, List, Tuple
 from pathlib import Path
+import os
 import shutil
 
 from recognize import Track
 from sanitize import sanitize_filename
+from library import Library
+
+
+PLACEHOLDERS = [
+    (r'%n', '{track_number}'),
+    (r'%t', '{title}'),
+    (r'%a', '{artist}'),
+    (r'%l', '{album}'),
+    (r'%m', '{media_name}'),
+]
 
 
 def check_arguments(args) -> bool:
     return True
 
 
-def rename_tracks(tracks: List[Track], media_file: str, rename_name_pattern: str, restricted_file_names: bool) -> List[Track]:
+# Translates the placeholders of the pattern into a format string, done once for all tracks.
+# num_tracks decides the number of leading zeros of %N.
+def compile_pattern(rename_name_pattern: str, num_tracks: int) -> str:
     format_str = rename_name_pattern
-    format_str = format_str.replace(r'%n', '{track_number}')
-    digits_needed = ceil(log10(len(tracks) + 1))
-    format_str = format_str.replace(r'%N', '{{track_number:0{}}}'.format(digits_needed))
-    format_str = format_str.replace(r'%t', '{title}')
-    format_str = format_str.replace(r'%a', '{artist}')
-    format_str = format_str.replace(r'%l', '{album}')
-    format_str = format_str.replace(r'%m', '{media_name}')
+    format_str = format_str.replace(r'%N', '{{track_number:0{}}}'.format(ceil(log10(num_tracks + 1))))
+    for placeholder, field in PLACEHOLDERS:
+        format_str = format_str.replace(placeholder, field)
     format_str += '{extension}'
     logger.debug('Constructed format string: {}.', format_str)
+    return format_str
+
+
+# Returns the new paths of all formats of each track, in the order of the tracks.
+# All formats of a track get the same name with their own extension.
+def plan_renames(tracks: List[Track], media_file: str, rename_name_pattern: str, restricted_file_names: bool) -> List[List[str]]:
+    format_str = compile_pattern(rename_name_pattern, len(tracks))
+    target_directory = Path(media_file).parent
+    media_name = Path(Path(media_file).name).stem
 
+    targets = []
     for track in tracks:
-        track_number = track.position + 1
-        title = track.title
-        title = 'Unknown Title' if title is None else title
-        artist = track.artist
-        artist = 'Unknown Artist' if artist is None else artist
-        album = track.album
-        album = 'Unknown Album' if album is None else album
-        media_name = Path(Path(media_file).name).stem
-        extension = Path(media_file).suffix
-
-        target_path = Path(media_file).parent
-        file_name = format_str.format(track_number=track_number, title=title, artist=artist, album=album, media_name=media_name, extension=extension)
-        file_name = sanitize_filename(file_name, restricted_file_names)
-        target_path = str(target_path.joinpath(file_name))
-
-        logger.trace('Renaming {} to {}.', track.file_path, target_path)
-        shutil.move(track.file_path, target_path)
-        track.file_path = target_path
+        fields = {
+            'track_number': track.position + 1,
+            'title': 'Unknown Title' if track.title is None else track.title,
+            'artist': 'Unknown Artist' if track.artist is None else track.artist,
+            'album': 'Unknown Album' if track.album is None else track.album,
+            'media_name': media_name,
+        }
+        track_targets = []
+        for file_path in track.all_file_paths():
+            file_name = sanitize_filename(format_str.format(extension=Path(file_path).suffix, **fields), restricted_file_names)
+            track_targets.append(str(target_directory.joinpath(file_name)))
+        targets.append(track_targets)
+    return targets
+
+
+def add_counter(path: str, counter: int, restricted_file_names: bool) -> str:
+    path = Path(path)
+    suffix = '_{}' if restricted_file_names else ' ({})'
+    return str(path.with_name(path.stem + suffix.format(counter) + path.suffix))
+
+
+# Makes the planned paths unique, e.g. if several unrecognized tracks would be named "Unknown Title".
+# The later tracks get a counter in the name, the same for all of their formats.
+# Files that are not part of the renaming are replaced, like before.
+def resolve_collisions(targets: List[List[str]], restricted_file_names: bool) -> int:
+    used = set()
+    collisions = 0
+    for i, track_targets in enumerate(targets):
+        keys = [os.path.normcase(target) for target in track_targets]
+        counter = 1
+        while any(key in used for key in keys):
+            counter += 1
+            track_targets = [add_counter(target, counter, restricted_file_names) for target in targets[i]]
+            keys = [os.path.normcase(target) for target in track_targets]
+        if counter > 1:
+            collisions += 1
+            logger.debug('Name {} is already taken, using {}.', targets[i][0], track_targets[0])
+        targets[i] = track_targets
+        used.update(keys)
+    return collisions
+
+
+# Moves all files or none of them, including the paths in the library if one is given.
+# Every file is moved to a temporary name next to its target first, so swapped names do not overwrite each other.
+# If a move or the library update fails, the files that were moved already are moved back, the same way in two steps.
+def apply_renames(moves: List[Tuple[str, str]], library: Library or None = None) -> None:
+    temp_paths = [str(Path(target).with_name('.{}.{}.renaming'.format(os.getpid(), i))) for i, (_, target) in enumerate(moves)]
+    # where each file currently is
+    locations: Dict[int, str] = {}
+    # moves whose target already was a hardlink to the same file, e.g. with --library-duplicates hardlink on a re-run
+    linked = set()
+    try:
+        for i, (source, target) in enumerate(moves):
+            shutil.move(source, temp_paths[i])
+            locations[i] = temp_paths[i]
+        for i, (source, target) in enumerate(moves):
+            logger.trace('Renaming {} to {}.', source, target)
+            os.replace(temp_paths[i], target)
+            # replacing a hardlink with another link to the same file does nothing, the temporary name is left
+            if os.path.exists(temp_paths[i]) and os.path.samefile(temp_paths[i], target):
+                os.remove(temp_paths[i])
+                linked.add(i)
+            locations[i] = target
+        if library is not None:
+            library.move_all(moves)
+    except Exception:
+        logger.error('Renaming failed, moving {} files back.', len(locations))
+        undo_renames(moves, temp_paths, locations, linked)
+        raise
+
+
+def undo_renames(moves: List[Tuple[str, str]], temp_paths: List[str], locations: Dict[int, str], linked: set) -> None:
+    for i in linked:
+        # the target belongs to the other link as well
+        os.link(moves[i][1], moves[i][0])
+    # first everything back to the temporary names, a source might be the target of another move
+    for i, location in locations.items():
+        if i not in linked and location != temp_paths[i]:
+            os.replace(location, temp_paths[i])
+    for i in locations.keys():
+        if i not in linked:
+            shutil.move(temp_paths[i], moves[i][0])
+
+
+# if a library is given, its paths are updated as well
+def rename_tracks(tracks: List[Track], media_file: str, rename_name_pattern: str, restricted_file_names: bool, library: Library or None = None) -> List[Track]:
+    targets = plan_renames(tracks, media_file, rename_name_pattern, restricted_file_names)
+    collisions = resolve_collisions(targets, restricted_file_names)
+    if collisions > 0:
+        logger.info('{} tracks got a counter in the name to keep the names unique.', collisions)
+
+    moves = []
+    for track, track_targets in zip(tracks, targets):
+        for file_path, target_path in zip(track.all_file_paths(), track_targets):
+            if file_path != target_path:
+                moves.append((file_path, target_path))
+    apply_renames(moves, library)
+
+    for track, track_targets in zip(tracks, targets):
+        track.file_path = track_targets[0]
+        track.variant_paths = track_targets[1:]
 
     return tracks
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+from loguru import logger
+from typing import Tuple
+import multiprocessing
+import os
+
+
+# Number of CPUs this process may actually use.
+# Respects the CPU affinity and cgroup (v1 and v2) CPU quotas, so inside a container
+# limited to 2 CPUs this returns 2 and not the number of cores of the host.
+def effective_cpu_count() -> int:
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        # not available on all platforms
+        cpus = multiprocessing.cpu_count()
+
+    quota = cgroup_cpu_quota()
+    if quota is not None:
+        logger.trace('cgroup CPU quota is {:.2f} CPUs, affinity allows {}.', quota, cpus)
+        cpus = min(cpus, max(1, int(quota + 0.5)))
+    return max(1, cpus)
+
+
+# CPU quota in number of CPUs, None if unlimited or unknown
+def cgroup_cpu_quota() -> float or None:
+    # cgroup v2: "<quota> <period>" or "max <period>"
+    try:
+        with open('/sys/fs/cgroup/cpu.max', 'r') as f:
+            quota, period = f.read().split()
+        if quota == 'max':
+            return None
+        return int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+
+    # cgroup v1: quota is -1 if unlimited
+    try:
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us', 'r') as f:
+            quota = int(f.read())
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us', 'r') as f:
+            period = int(f.read())
+        if quota <= 0 or period <= 0:
+            return None
+        return quota / period
+    except (OSError, ValueError):
+        return None
+
+
+# Memory available to this process in bytes, the smaller one of the cgroup limit and the free system memory.
+# None if unknown.
+def available_memory() -> int or None:
+    available = None
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    available = int(line.split()[1]) * 1024
+                    break
+    except (OSError, ValueError):
+        pass
+
+    limit = None
+    # cgroup v2 and v1, v1 reports a huge number if unlimited
+    for limit_path, usage_path in [
+            ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory.current'),
+            ('/sys/fs/cgroup/memory/memory.limit_in_bytes', '/sys/fs/cgroup/memory/memory.usage_in_bytes')]:
+        try:
+            with open(limit_path, 'r') as f:
+                raw_limit = f.read().strip()
+            if raw_limit == 'max':
+                break
+            with open(usage_path, 'r') as f:
+                usage = int(f.read())
+            limit = max(0, int(raw_limit) - usage)
+            break
+        except (OSError, ValueError):
+            continue
+
+    if available is None:
+        return limit
+    if limit is None:
+        return available
+    return min(available, limit)
+
+
+# Fraction (0 to 1) of the host CPUs busy with other work, based on the 1 minute load average.
+# Must be called before starting our own work, otherwise it counts that as well.
+def foreign_cpu_load() -> float:
+    try:
+        load = os.getloadavg()[0]
+    except (AttributeError, OSError):
+        return 0.0
+    # the load average is always host wide, so compare it to the host CPUs
+    return min(1.0, load / multiprocessing.cpu_count())
+
+
+# Cumulative (iowait, total) CPU time since boot, None if unknown.
+# Take two samples and use iowait_fraction() to get the iowait over that period.
+def cpu_times() -> Tuple[int, int] or None:
+    try:
+        with open('/proc/stat', 'r') as f:
+            fields = f.readline().split()
+        if fields[0] != 'cpu':
+            return None
+        values = [int(v) for v in fields[1:]]
+        # user nice system idle iowait ...
+        return values[4], sum(values)
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def iowait_fraction(before: Tuple[int, int] or None, after: Tuple[int, int] or None) -> float or None:
+    if before is None or after is None:
+        return None
+    total = after[1] - before[1]
+    if total <= 0:
+        return None
+    return (after[0] - before[0]) / total
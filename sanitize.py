@@ -20,6 +20,60 @@ NO_DEFAULT = object()
 def remove_start(s, start):
     return s[len(start):] if s is not None and s.startswith(start) else s
 
+# precompiled for sanitize_filename, which runs once per file name
+TIMESTAMP_RE = re.compile(r'[0-9]+(?::[0-9]+)+')
+REPEATED_SUBSTITUTE_RE = re.compile(r'(\0.)(?:(?=\1)..)+')
+STRIP_RE = r'(?:\0.|[ _-])*'
+SUBSTITUTE_START_END_RE = re.compile(f'^\0.{STRIP_RE}|{STRIP_RE}\0.$')
+
+
+def replace_insane(char, restricted, is_id):
+    if restricted and char in ACCENT_CHARS:
+        return ACCENT_CHARS[char]
+    elif not restricted and char == '\n':
+        return '\0 '
+    elif is_id is NO_DEFAULT and not restricted and char in '"*:<>?|/\\':
+        # Replace with their full-width unicode counterparts
+        return {'/': '\u29F8', '\\': '\u29f9'}.get(char, chr(ord(char) + 0xfee0))
+    elif char == '?' or ord(char) < 32 or ord(char) == 127:
+        return ''
+    elif char == '"':
+        return '' if restricted else '\''
+    elif char == ':':
+        return '\0_\0-' if restricted else '\0 \0-'
+    elif char in '\\/|*<>':
+        return '\0_'
+    if restricted and (char in '!&\'()[]{}$;`^,#' or char.isspace() or ord(char) > 127):
+        return '\0_'
+    return char
+
+
+# Translation table for str.translate doing replace_insane for every character in one call.
+# Filled lazily, as any character above 127 might show up.
+class ReplaceTable(dict):
+    def __init__(self, restricted, is_id):
+        super().__init__()
+        self.restricted = restricted
+        self.is_id = is_id
+        for code in range(128):
+            self[code] = replace_insane(chr(code), restricted, is_id)
+
+    def __missing__(self, code):
+        replacement = self[code] = replace_insane(chr(code), self.restricted, self.is_id)
+        return replacement
+
+
+# only whether is_id is NO_DEFAULT matters to replace_insane
+REPLACE_TABLES = {}
+
+
+def get_replace_table(restricted, is_id):
+    key = (bool(restricted), is_id is NO_DEFAULT)
+    if key not in REPLACE_TABLES:
+        REPLACE_TABLES[key] = ReplaceTable(restricted, is_id)
+    return REPLACE_TABLES[key]
+
+
 def sanitize_filename(s, restricted=False, is_id=NO_DEFAULT):
     """Sanitizes a string so it could be used as part of a filename.
     @param restricted   Use a stricter subset of allowed characters
@@ -29,34 +83,13 @@ def sanitize_filename(s, restricted=False, is_id=NO_DEFAULT):
     if s == '':
         return ''
 
-    def replace_insane(char):
-        if restricted and char in ACCENT_CHARS:
-            return ACCENT_CHARS[char]
-        elif not restricted and char == '\n':
-            return '\0 '
-        elif is_id is NO_DEFAULT and not restricted and char in '"*:<>?|/\\':
-            # Replace with their full-width unicode counterparts
-            return {'/': '\u29F8', '\\': '\u29f9'}.get(char, chr(ord(char) + 0xfee0))
-        elif char == '?' or ord(char) < 32 or ord(char) == 127:
-            return ''
-        elif char == '"':
-            return '' if restricted else '\''
-        elif char == ':':
-            return '\0_\0-' if restricted else '\0 \0-'
-        elif char in '\\/|*<>':
-            return '\0_'
-        if restricted and (char in '!&\'()[]{}$;`^,#' or char.isspace() or ord(char) > 127):
-            return '\0_'
-        return char
-
     if restricted and is_id is NO_DEFAULT:
         s = unicodedata.normalize('NFKC', s)
-    s = re.sub(r'[0-9]+(?::[0-9]+)+', lambda m: m.group(0).replace(':', '_'), s)  # Handle timestamps
-    result = ''.join(map(replace_insane, s))
+    s = TIMESTAMP_RE.sub(lambda m: m.group(0).replace(':', '_'), s)  # Handle timestamps
+    result = s.translate(get_replace_table(restricted, is_id))
     if is_id is NO_DEFAULT:
-        result = re.sub(r'(\0.)(?:(?=\1)..)+', r'\1', result)  # Remove repeated substitute chars
-        STRIP_RE = r'(?:\0.|[ _-])*'
-        result = re.sub(f'^\0.{STRIP_RE}|{STRIP_RE}\0.$', '', result)  # Remove substitute chars from start/end
+        result = REPEATED_SUBSTITUTE_RE.sub(r'\1', result)  # Remove repeated substitute chars
+        result = SUBSTITUTE_START_END_RE.sub('', result)  # Remove substitute chars from start/end
     result = result.replace('\0', '') or '_'
 
     if not is_id:
@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+
+from loguru import logger
+import resources
+from typing import Callable, List, Any
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import json
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows, sharing a bucket between processes is not supported there
+    fcntl = None
+
+
+# Token bucket limiting the rate of calls.
+# If a state file is given, the bucket is shared with all other processes using the same file.
+# This way several concurrent jobs (e.g. multiple instances of this program) together stay below the limit.
+class TokenBucket:
+    def __init__(self, rate: float, burst: float = 1.0, state_file: str or None = None):
+        if rate <= 0:
+            raise ValueError('Rate of a token bucket must be positive, got {}.'.format(rate))
+        if state_file is not None and fcntl is None:
+            raise ValueError('Sharing a token bucket via a state file is not supported on this platform.')
+        self.rate = rate
+        self.burst = max(burst, 1.0)
+        self.state_file = state_file
+        self.tokens = self.burst
+        self.last_refill = time.time()
+        self.lock = threading.Lock()
+
+    def _refill(self, tokens: float, last_refill: float, now: float) -> float:
+        return min(self.burst, tokens + (now - last_refill) * self.rate)
+
+    # takes a token if available, otherwise returns the number of seconds until the next one is available
+    def _try_take_local(self) -> float:
+        with self.lock:
+            now = time.time()
+            self.tokens = self._refill(self.tokens, self.last_refill, now)
+            self.last_refill = now
+            if self.tokens >= 1.0:
+                self.tokens -= 1.0
+                return 0.0
+            return (1.0 - self.tokens) / self.rate
+
+    def _try_take_shared(self) -> float:
+        # the thread lock is needed as well, flock is per open file description and not per thread
+        with self.lock:
+            with open(self.state_file, 'a+') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    f.seek(0)
+                    now = time.time()
+                    try:
+                        state = json.loads(f.read())
+                        tokens = self._refill(float(state['tokens']), float(state['last_refill']), now)
+                    except (ValueError, KeyError, TypeError):
+                        # new or corrupted state file, start with a full bucket
+                        tokens = self.burst
+                    wait = 0.0
+                    if tokens >= 1.0:
+                        tokens -= 1.0
+                    else:
+                        wait = (1.0 - tokens) / self.rate
+                    f.seek(0)
+                    f.truncate()
+                    f.write(json.dumps({'tokens': tokens, 'last_refill': now}))
+                    f.flush()
+                    return wait
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    # blocks until a token could be taken
+    def acquire(self) -> None:
+        while True:
+            if self.state_file is None:
+                wait = self._try_take_local()
+            else:
+                wait = self._try_take_shared()
+            if wait <= 0.0:
+                return
+            logger.trace('Token bucket empty, waiting {:.3f}s.', wait)
+            time.sleep(wait)
+
+
+# Runs a function over a list of items with a concurrency limit controlled by AIMD
+# (additive increase, multiplicative decrease), like TCP congestion control.
+# Every error or a call taking much longer than usual (compared to a moving average of the latencies) halves the limit,
+# each window of successful calls increases it by one. If the items differ in size, map takes the cost of each item
+# (e.g. the seconds of audio), the latencies are then compared per unit of cost.
+# Failed calls are retried with backoff, after max_retries the last exception is raised.
+# For functions signaling failures by their return value, is_failure tells which results are failures,
+# those count like errors, but are returned instead of raised.
+class AdaptiveScheduler:
+    def __init__(self, initial_limit: int, max_limit: int, min_limit: int = 1,
+                 bucket: TokenBucket or None = None, adaptive: bool = True,
+                 latency_factor: float = 2.0, decrease_factor: float = 0.5,
+                 max_retries: int = 3, retry_backoff: float = 1.0,
+                 is_failure: Callable[[Any], bool] or None = None):
+        if min_limit < 1 or max_limit < min_limit:
+            raise ValueError('Invalid scheduler limits: min {}, max {}.'.format(min_limit, max_limit))
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(min(max(initial_limit, min_limit), max_limit))
+        self.bucket = bucket
+        self.adaptive = adaptive
+        self.latency_factor = latency_factor
+        self.decrease_factor = decrease_factor
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.is_failure = is_failure
+
+        # statistics, only modified while holding the condition
+        self.in_flight = 0
+        self.completed = 0
+        self.errors = 0
+        self.retries = 0
+        self.decreases = 0
+        self.min_latency = None
+        self.avg_latency = None
+        # moving average of the latency per unit of cost, the baseline for slow calls
+        self.avg_cost_latency = None
+        self.cost = None
+        # no further decrease until all calls started before the last decrease have finished
+        # otherwise a single burst of errors would collapse the limit to the minimum
+        self.started = 0
+        self.decrease_barrier = 0
+
+        self.queue = deque()
+        self.condition = threading.Condition()
+
+    def queue_depth(self) -> int:
+        with self.condition:
+            return len(self.queue)
+
+    def current_limit(self) -> int:
+        with self.condition:
+            return int(self.limit)
+
+    def metrics(self) -> dict:
+        with self.condition:
+            return {
+                'limit': int(self.limit),
+                'queue_depth': len(self.queue),
+                'in_flight': self.in_flight,
+                'completed': self.completed,
+                'errors': self.errors,
+                'retries': self.retries,
+                'decreases': self.decreases,
+                'min_latency': self.min_latency,
+                'avg_latency': self.avg_latency,
+                'avg_cost_latency': self.avg_cost_latency,
+            }
+
+    # must be called with the condition held
+    def _on_result(self, item: Any, latency: float, failed: bool, start_sequence: int) -> None:
+        self.in_flight -= 1
+        slow = False
+        if failed:
+            self.errors += 1
+        else:
+            self.completed += 1
+            self.min_latency = latency if self.min_latency is None else min(self.min_latency, latency)
+            # exponentially weighted moving averages
+            self.avg_latency = latency if self.avg_latency is None else 0.8 * self.avg_latency + 0.2 * latency
+            cost = self.cost(item) if self.cost is not None else 1.0
+            cost_latency = latency / cost if cost > 0 else latency
+            # compared before the update, a throttled call would otherwise raise its own baseline
+            slow = self.avg_cost_latency is not None and cost_latency > self.avg_cost_latency * self.latency_factor
+            self.avg_cost_latency = cost_latency if self.avg_cost_latency is None else 0.8 * self.avg_cost_latency + 0.2 * cost_latency
+
+        if not self.adaptive:
+            return
+
+        if failed or slow:
+            if start_sequence > self.decrease_barrier:
+                old_limit = self.limit
+                self.limit = max(float(self.min_limit), self.limit * self.decrease_factor)
+                self.decreases += 1
+                self.decrease_barrier = self.started
+                logger.debug('Decreased concurrency from {} to {} after {} call ({:.2f}s).',
+                    int(old_limit), int(self.limit), 'failed' if failed else 'slow', latency)
+        else:
+            # one full increase per window of limit calls
+            old_limit = self.limit
+            self.limit = min(float(self.max_limit), self.limit + 1.0 / self.limit)
+            if int(self.limit) != int(old_limit):
+                logger.trace('Increased concurrency from {} to {}.', int(old_limit), int(self.limit))
+
+    def _run_one(self, func: Callable, index: int, item: Any, attempt: int, start_sequence: int, results: dict,
+                 on_done: Callable[[int, Any, Any], None] or None) -> None:
+        start = time.monotonic()
+        try:
+            result = func(item)
+            failed = self.is_failure is not None and self.is_failure(result)
+        except Exception as e:
+            result = e
+            failed = True
+        latency = time.monotonic() - start
+
+        done = True
+        with self.condition:
+            self._on_result(item, latency, failed, start_sequence)
+            if not failed:
+                results[index] = result
+            elif attempt < self.max_retries:
+                self.retries += 1
+                not_before = time.monotonic() + self.retry_backoff * (2 ** attempt)
+                logger.warning('Call for item {} failed (attempt {} of {}), retrying: {}', index, attempt + 1, self.max_retries + 1, result)
+                self.queue.append((index, item, attempt + 1, not_before))
+                done = False
+            else:
+                results[index] = result
+            self.condition.notify_all()
+
+        if done and on_done is not None:
+            on_done(index, item, result)
+
+    # Returns the results in the order of the items, like Pool.map.
+    # on_done is called with the index, item and result (or exception) as soon as an item is finished.
+    # cost optionally returns the relative cost of an item, see the class description.
+    # With return_exceptions the exceptions of items that failed after all retries are returned instead of raised.
+    def map(self, func: Callable, items: List[Any], on_done: Callable[[int, Any, Any], None] or None = None,
+            cost: Callable[[Any], float] or None = None, return_exceptions: bool = False) -> List[Any]:
+        results = {}
+        with self.condition:
+            if cost is not self.cost:
+                # latencies per unit of another cost are not comparable, start a new baseline
+                self.avg_cost_latency = None
+            self.cost = cost
+            self.queue.extend((i, item, 0, 0.0) for i, item in enumerate(items))
+
+        logger.trace('Starting adaptive scheduler for {} items with limit {} (max {}).', len(items), int(self.limit), self.max_limit)
+        with ThreadPoolExecutor(self.max_limit) as executor:
+            while True:
+                with self.condition:
+                    if len(self.queue) == 0 and self.in_flight == 0:
+                        break
+                    if len(self.queue) == 0 or self.in_flight >= int(self.limit):
+                        self.condition.wait()
+                        continue
+                    # pick the first item that is not waiting for a retry backoff
+                    now = time.monotonic()
+                    ready = next((entry for entry in self.queue if entry[3] <= now), None)
+                    if ready is None:
+                        self.condition.wait(min(entry[3] for entry in self.queue) - now)
+                        continue
+                    self.queue.remove(ready)
+                    self.in_flight += 1
+                    self.started += 1
+                    start_sequence = self.started
+
+                # wait for the rate limit outside of the lock, completions must still be processed
+                if self.bucket is not None:
+                    self.bucket.acquire()
+                index, item, attempt, _ = ready
+                executor.submit(self._run_one, func, index, item, attempt, start_sequence, results, on_done)
+                logger.trace('Scheduler metrics: {}.', self.metrics())
+
+        logger.debug('Scheduler finished: {}.', self.metrics())
+        ret = [results[i] for i in range(len(items))]
+        if not return_exceptions:
+            for r in ret:
+                if isinstance(r, Exception):
+                    raise r
+        return ret
+
+
+# Runs a function over a list of items, adjusting the concurrency limit by hill climbing on the throughput.
+# The throughput is the summed weight of the items (e.g. seconds of audio) per second of wall time.
+# After each window of calls the limit is moved one step in the current direction,
+# the direction is reversed if the throughput got worse. High iowait always reduces the limit,
+# in that case the disk is the bottleneck and more parallel calls only make it worse.
+class ThroughputScheduler(AdaptiveScheduler):
+    def __init__(self, initial_limit: int, max_limit: int, weight: Callable[[Any], float],
+                 min_limit: int = 1, adaptive: bool = True, iowait_threshold: float = 0.3,
+                 is_failure: Callable[[Any], bool] or None = None):
+        super().__init__(initial_limit, max_limit, min_limit, adaptive=adaptive, max_retries=0, is_failure=is_failure)
+        self.weight = weight
+        self.iowait_threshold = iowait_threshold
+        self.direction = 1
+        self.throughput = None
+        self._start_window()
+
+    # must be called with the condition held
+    def _start_window(self) -> None:
+        self.window_start = time.monotonic()
+        self.window_cpu_times = resources.cpu_times()
+        self.window_weight = 0.0
+        self.window_count = 0
+
+    def metrics(self) -> dict:
+        ret = super().metrics()
+        with self.condition:
+            ret['throughput'] = self.throughput
+        return ret
+
+    def _on_result(self, item: Any, latency: float, failed: bool, start_sequence: int) -> None:
+        self.in_flight -= 1
+        if failed:
+            self.errors += 1
+            return
+        self.completed += 1
+        self.window_weight += self.weight(item)
+        self.window_count += 1
+
+        # evaluate after twice the current limit calls to average out differences between items
+        if not self.adaptive or self.window_count < 2 * int(self.limit):
+            return
+
+        elapsed = time.monotonic() - self.window_start
+        throughput = self.window_weight / elapsed if elapsed > 0 else None
+        iowait = resources.iowait_fraction(self.window_cpu_times, resources.cpu_times())
+        if iowait is not None and iowait > self.iowait_threshold:
+            self.direction = -1
+        elif throughput is not None and self.throughput is not None and throughput < self.throughput * 0.95:
+            self.direction = -self.direction
+
+        old_limit = self.limit
+        self.limit = float(min(self.max_limit, max(self.min_limit, int(self.limit) + self.direction)))
+        logger.debug('Throughput {} with {} parallel calls (iowait {}), changing limit to {}.',
+            '{:.2f}'.format(throughput) if throughput is not None else 'unknown', int(old_limit),
+            '{:.2f}'.format(iowait) if iowait is not None else 'unknown', int(self.limit))
+        self.throughput = throughput
+        self._start_window()
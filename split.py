@@ -1,36 +1,139 @@
 #!/usr/bin/env python3
 
 from loguru import logger
-from typing import List
+from typing import List, Tuple
 from pathlib import Path
-import os
 import subprocess
-import multiprocessing
 from functools import partial
 
 from timestamps import format_timestamp
+import resources
+import scheduler
+import progress
+
+
+# relative CPU cost of encoding a format compared to mp3, used to pick the number of parallel splits
+ENCODER_COSTS = {
+    '.wav': 0.25,
+    '.flac': 0.5,
+    '.mp3': 1.0,
+    '.m4a': 1.0,
+    '.aac': 1.0,
+    '.ogg': 1.0,
+    '.opus': 1.25,
+}
+# rough upper bound of the memory used by a single ffmpeg process
+FFMPEG_MEMORY = 100 * 1024 * 1024
+
+
+# defaults for the offsets and fades, (for second accurate timestamps, for sub-second accurate timestamps)
+# accurate timestamps need a smaller safety margin
+DEFAULT_START_OFFSET = (1, 0)
+DEFAULT_FADE_IN = (2, 0.5)
+DEFAULT_END_OFFSET = (-1, 0)
+DEFAULT_FADE_OUT = (3, 1)
 
 
 # Wrapper class to hold all the config options
 class SplitConfig:
-    def __init__(self, args = None):
+    def __init__(self, args = None, precise: bool = False):
+        defaults = 1 if precise else 0
         self.num_threads = args.split_num_threads if args is not None else 0
-        self.start_offset = args.split_start_offset if args is not None else 1
-        self.fade_in = args.split_fade_in if args is not None else 2
-        self.end_offset = args.split_end_offset if args is not None else -1
-        self.fade_out = args.split_fade_out if args is not None else 3
+        self.start_offset = DEFAULT_START_OFFSET[defaults]
+        self.fade_in = DEFAULT_FADE_IN[defaults]
+        self.end_offset = DEFAULT_END_OFFSET[defaults]
+        self.fade_out = DEFAULT_FADE_OUT[defaults]
+        if args is not None:
+            # None means not given on the command line
+            self.start_offset = args.split_start_offset if args.split_start_offset is not None else self.start_offset
+            self.fade_in = args.split_fade_in if args.split_fade_in is not None else self.fade_in
+            self.end_offset = args.split_end_offset if args.split_end_offset is not None else self.end_offset
+            self.fade_out = args.split_fade_out if args.split_fade_out is not None else self.fade_out
         self.file_pattern = args.split_file_pattern if args is not None else r'fragment_%n'
-        if self.num_threads == 0:
-            self.num_threads = multiprocessing.cpu_count()
+        self.adaptive = args.split_adaptive if args is not None else True
+        # extensions (without dot) of all output formats, the first is the primary one
+        # None means the same format as the media file
+        self.output_formats = parse_output_formats(args.split_output_formats) if args is not None else None
+        # optional decoded media, see workspace.PcmWorkspace
+        self.workspace = None
 
     def has_fade(self) -> bool:
         return self.fade_in != 0 or self.fade_out != 0
 
+    # extensions including the dot, the first one is used for recognizing
+    def get_extensions(self, media_file_path: str) -> List[str]:
+        if self.output_formats is None:
+            return [Path(media_file_path).suffix]
+        return ['.' + f for f in self.output_formats]
+
+    # without fade an output in the same format as the media can be copied straight
+    def is_copy(self, media_file_path: str, extension: str) -> bool:
+        return not self.has_fade() and extension.lower() == Path(media_file_path).suffix.lower()
+
+    # the encoders can be fed from the workspace unless the original stream needs to be copied
+    # or the workspace has less bits or channels than the source
+    def uses_workspace(self, media_file_path: str) -> bool:
+        return self.workspace is not None and self.workspace.lossless and not any(
+            self.is_copy(media_file_path, extension) for extension in self.get_extensions(media_file_path))
+
+    # Returns the initial and the maximum number of parallel splits.
+    # A fixed num_threads is used as is, 0 picks the numbers based on the split mode,
+    # the output format and the available CPUs and memory.
+    def get_num_threads(self, media_file_path: str) -> Tuple[int, int]:
+        if self.num_threads != 0:
+            return self.num_threads, self.num_threads
+
+        cpus = resources.effective_cpu_count()
+        # leave room for whatever else is running on the machine
+        free_cpus = max(1, round(cpus * (1.0 - resources.foreign_cpu_load())))
+        # each ffmpeg encoder is single threaded, a single call encodes all output formats
+        cost = sum(ENCODER_COSTS.get(extension.lower(), 1.0)
+            for extension in self.get_extensions(media_file_path)
+            if not self.is_copy(media_file_path, extension))
+        if cost == 0:
+            # copying is bound by I/O, a few parallel splits are enough to keep the disk busy
+            initial = min(4, 2 * free_cpus)
+            maximum = min(32, max(initial, 4 * cpus))
+        else:
+            # cheap encoders leave time for I/O
+            initial = max(1, min(2 * cpus, round(free_cpus / cost)))
+            maximum = max(initial, 2 * cpus)
+
+        memory = resources.available_memory()
+        if memory is not None:
+            memory_limit = max(1, memory // FFMPEG_MEMORY)
+            initial = min(initial, memory_limit)
+            maximum = min(maximum, memory_limit)
+
+        if not self.adaptive:
+            maximum = initial
+        logger.debug('Auto split threads: {} CPUs ({} free), encoding cost: {}, starting with {} threads, max {}.',
+            cpus, free_cpus, cost, initial, maximum)
+        return initial, maximum
+
+
+# "flac,mp3" -> ['flac', 'mp3']
+def parse_output_formats(output_formats: str or None) -> List[str] or None:
+    if output_formats is None:
+        return None
+    return [f.strip().lstrip('.').lower() for f in output_formats.split(',') if len(f.strip()) > 0]
+
 
 def check_arguments(args) -> bool:
+    if args.split_num_threads < 0:
+        print('--split-num-threads must not be negative.')
+        return False
     if r'%n' not in args.split_file_pattern:
         print(r'--split-file-pattern must contain at least one %n.')
         return False
+    output_formats = parse_output_formats(args.split_output_formats)
+    if output_formats is not None:
+        if len(output_formats) == 0:
+            print('--split-output-formats must contain at least one format.')
+            return False
+        if len(set(output_formats)) != len(output_formats):
+            print('--split-output-formats must not contain a format twice.')
+            return False
     # dummy call in case more verification is later added to the constructor of SplitConfig
     dummy = SplitConfig(args)
     logger.trace('Created config object {}.', dummy)
@@ -42,12 +145,61 @@ def check_arguments(args) -> bool:
     return True
 
 
-def get_config_from_arguments(args) -> SplitConfig:
-    return SplitConfig(args)
+def get_config_from_arguments(args, precise: bool = False) -> SplitConfig:
+    return SplitConfig(args, precise)
+
+
+# Start and end of the fragment in the media in seconds, as cut by split_file.
+# The end of the last fragment is None, it ends with the media.
+def get_fragment_range(timestamps: List[float], index: int, config: SplitConfig) -> Tuple[float, float or None]:
+    start = max(0, timestamps[index] + config.start_offset)
+    end = None
+    if index < len(timestamps) - 1:
+        end = timestamps[index + 1] - config.end_offset
+    return start, end
+
+
+# Duration of the fragment in seconds, as cut by split_file, without probing the output.
+# The last fragment ends with the media, its duration is None if media_duration is unknown.
+def get_fragment_duration(timestamps: List[float], index: int, config: SplitConfig, media_duration: float or None = None) -> float or None:
+    start, end = get_fragment_range(timestamps, index, config)
+    if end is None:
+        end = media_duration
+    elif media_duration is not None:
+        end = min(end, media_duration)
+    if end is None:
+        return None
+    return max(0, end - start)
 
 
-def split_file(media_file_path: str, config : SplitConfig, proto_ffmpeg_args : List[str], timestamps: List[int], index: int):
-    media_file_extension = Path(media_file_path).suffix
+# Duration of the media in seconds from a single ffprobe call, None if unknown.
+def probe_media_duration(media_file_path: str) -> float or None:
+    ffprobe_args = [
+        'ffprobe',
+        '-loglevel', 'error',
+        '-show_entries', 'format=duration',
+        '-of', 'default=noprint_wrappers=1:nokey=1',
+        media_file_path,
+    ]
+    logger.trace('Calling ffprobe with arguments: {}.', ffprobe_args)
+    try:
+        proc = subprocess.run(ffprobe_args, capture_output=True, text=True)
+    except OSError as e:
+        logger.debug('Unable to run ffprobe: {}', e)
+        return None
+    if proc.returncode != 0:
+        logger.debug('ffprobe for {} failed with code {}, stderr: {}.', media_file_path, proc.returncode, proc.stderr)
+        return None
+    try:
+        return float(proc.stdout.strip())
+    except ValueError:
+        return None
+
+
+# Splits one fragment into all output formats with a single ffmpeg call, so the media is only decoded once.
+# Returns the file names of all formats, the primary one first, or None on failure.
+def split_file(media_file_path: str, config : SplitConfig, proto_ffmpeg_args : List[str], split_destination_directory: str,
+               timestamps: List[float], index: int) -> List[str] or None:
     media_file_name = Path(Path(media_file_path).name).stem
 
     start = timestamps[index] + config.start_offset
@@ -68,35 +220,63 @@ def split_file(media_file_path: str, config : SplitConfig, proto_ffmpeg_args : L
     logger.trace('Splitting fragment index {} from {}.', index, from_to_str)
 
     my_args = proto_ffmpeg_args[:]
-
-    if config.has_fade():
-        my_args[-2] = my_args[-2].format(fadestart, fadeend)
-
-    new_args = [None, '-to', None, None]
-    new_args[0] = str(start)
-    new_args[2] = str(end)
+    use_workspace = config.uses_workspace(media_file_path)
+    if use_workspace:
+        # the fragment is piped in, so all times are relative to its start
+        # the last fragment keeps the fade out beyond its end, it does not fade out like without a workspace
+        fadestart = 0
+        if end != 0xffffffff:
+            fadeend = fadeend - start
 
     # replace % placeholders with references to variables
     file_pattern = config.file_pattern[:]
     file_pattern = file_pattern.replace(r'%n', '{index}')
     file_pattern = file_pattern.replace(r'%f', '{media_file_name}')
-    file_name = file_pattern.format(index=index, media_file_name=media_file_name) + media_file_extension
-    new_args[3] = file_name
-    my_args.extend(new_args)
+    file_stem = file_pattern.format(index=index, media_file_name=media_file_name)
+
+    # the options apply to the next output file, so repeat them for each format
+    file_names = []
+    for extension in config.get_extensions(media_file_path):
+        if config.has_fade():
+            my_args.extend([
+                '-af',
+                'afade=t=in:st={}:d={},afade=t=out:st={}:d={}'.format(
+                    fadestart, config.fade_in, fadeend, config.fade_out),
+            ])
+        elif config.is_copy(media_file_path, extension):
+            # without fade we can do a straight copy to save a lot of time
+            my_args.extend(['-acodec', 'copy'])
+        file_name = str(Path(split_destination_directory).joinpath(file_stem + extension))
+        if not use_workspace:
+            my_args.extend(['-ss', str(start), '-to', str(end)])
+        my_args.append(file_name)
+        file_names.append(file_name)
     cmdline = ' '.join(my_args)
     logger.trace('ffmpeg call for index {}, from {}: {}.', index, from_to_str, cmdline)
-    proc = subprocess.run(my_args, capture_output=True, text=True)
-    if proc.returncode != 0:
-        logger.error('Failed processing fragment index {} (from {}) with code {}. stdout: {}, stderr: {}.', index, from_to_str, proc.returncode, proc.stdout, proc.stderr)
+    if use_workspace:
+        # feed the encoders straight from the memory-mapped workspace
+        data = config.workspace.slice(start, end if end != 0xffffffff else None)
+        proc = subprocess.Popen(my_args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = proc.communicate(data)
+        data.release()
+        returncode, stdout, stderr = proc.returncode, stdout.decode(errors='replace'), stderr.decode(errors='replace')
+    else:
+        proc = subprocess.run(my_args, capture_output=True, text=True)
+        returncode, stdout, stderr = proc.returncode, proc.stdout, proc.stderr
+    if returncode != 0:
+        logger.error('Failed processing fragment index {} (from {}) with code {}. stdout: {}, stderr: {}.', index, from_to_str, returncode, stdout, stderr)
         return None
-    logger.trace('Split fragment index {} (from {}) to {}.', index, from_to_str, file_name)
-    return file_name
+    logger.trace('Split fragment index {} (from {}) to {}.', index, from_to_str, file_names)
+    return file_names
 
 
-def split_files(media_file_path: str, timestamps: List[int], split_destination_directory: str, config: SplitConfig) -> List[str]:
-    old_wd = os.getcwd()
+# Like split_files, but also returns the index of the timestamp each fragment belongs to,
+# the paths of all output formats, the primary one first, and the duration of the fragment (see get_fragment_duration).
+# Failed fragments are skipped, so the index can differ from the position in the result.
+# If progress_stage is set, each finished fragment is reported as progress of that stage.
+def split_files_indexed(media_file_path: str, timestamps: List[float], split_destination_directory: str, config: SplitConfig,
+                        media_duration: float or None = None, progress_stage: str or None = None) -> List[Tuple[int, List[str], float or None]]:
     media_file_path = str(Path(media_file_path).resolve())
-    os.chdir(split_destination_directory)
 
     proto_ffmpeg_args = [
         'ffmpeg',
@@ -104,39 +284,48 @@ def split_files(media_file_path: str, timestamps: List[int], split_destination_d
         'error',
         '-y',
         '-hide_banner',
-        '-i',
-        media_file_path,
     ]
-    if config.has_fade():
-        proto_ffmpeg_args.extend([
-            '-af',
-            'afade=t=in:st={{}}:d={},afade=t=out:st={{}}:d={}'.format(
-                config.fade_in, config.fade_out),
-        ])
+    if config.uses_workspace(media_file_path):
+        proto_ffmpeg_args.extend(config.workspace.ffmpeg_input_args())
+        logger.debug('Splitting from workspace {}.', config.workspace.pcm_path)
     else:
-        proto_ffmpeg_args.extend([
-            # without fade we can do a straight copy to save a lot of time
-            '-acodec', 'copy',
-        ])
-    proto_ffmpeg_args.extend([
-        '-ss',
-    ])
+        if config.workspace is not None and not config.workspace.lossless:
+            logger.debug('Source has more than 16 bits or 2 channels, splitting from the media instead of the workspace.')
+        proto_ffmpeg_args.extend(['-i', media_file_path])
+
+    # the fragment lengths are the weights for measuring the throughput
+    # the length of the last one is unknown, assume an average one
+    durations = [timestamps[i + 1] - timestamps[i] for i in range(len(timestamps) - 1)]
+    average_duration = sum(durations) / len(durations) if len(durations) > 0 else 1
+    durations.append(average_duration)
 
-    pool = multiprocessing.Pool(config.num_threads)
+    # ffmpeg runs in its own process, threads are enough to drive it
+    initial_threads, max_threads = config.get_num_threads(media_file_path)
+    # split_file returns None for failed fragments, they must not count towards the throughput
+    split_scheduler = scheduler.ThroughputScheduler(initial_threads, max_threads, lambda index: durations[index],
+        is_failure=lambda file_names: file_names is None)
     # need to map a new iterable over the indicies
     # each iteration needs access to the full timestamp list
-    single_iteration_partial = partial(split_file, media_file_path, config, proto_ffmpeg_args, timestamps)
-    logger.trace('Starting splitting with {} threads.', config.num_threads)
-    raw_rets = pool.map(single_iteration_partial, range(len(timestamps)))
+    single_iteration_partial = partial(split_file, media_file_path, config, proto_ffmpeg_args, split_destination_directory, timestamps)
+    logger.trace('Starting splitting with {} threads (max {}).', initial_threads, max_threads)
+    on_done = None
+    if progress_stage is not None:
+        on_done = lambda index, _, file_names: progress.item_done(progress_stage, index, ok=isinstance(file_names, list), weight=durations[index])
+    raw_rets = split_scheduler.map(single_iteration_partial, list(range(len(timestamps))), on_done)
     logger.debug('Split into {} fragments.', len(raw_rets))
 
     result_file_paths = []
-    for f in raw_rets:
-        if f is None:
+    for index, file_names in enumerate(raw_rets):
+        if file_names is None:
             continue
-        abs_path = str(Path(f).resolve(True))
-        logger.trace('Resolved {} to {}.', f, abs_path)
-        result_file_paths.append(abs_path)
-    
-    os.chdir(old_wd)
+        abs_paths = [str(Path(f).resolve(True)) for f in file_names]
+        logger.trace('Resolved {} to {}.', file_names, abs_paths)
+        duration = get_fragment_duration(timestamps, index, config, media_duration)
+        result_file_paths.append((index, abs_paths, duration))
+
     return result_file_paths
+
+
+# returns the paths of the primary format
+def split_files(media_file_path: str, timestamps: List[float], split_destination_directory: str, config: SplitConfig) -> List[str]:
+    return [paths[0] for _, paths, _ in split_files_indexed(media_file_path, timestamps, split_destination_directory, config)]
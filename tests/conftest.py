@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# the modules live in the top level directory of the repository
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+
+# Stand-in for songrec that simulates the throttling of the Shazam API, for testing the scheduler.
+# Usage like songrec: fake_songrec.py audio-file-to-recognized-song <file>
+# The state directory (FAKE_SONGREC_STATE_DIR) holds a file per running call and the file max_concurrent.
+# If more calls than max_concurrent run at the same time, the call fails like a throttled songrec.
+# Each call takes FAKE_SONGREC_LATENCY seconds (default 0.05), the song is named after the file.
+# Every call appends its start time and the number of running calls it saw to calls.log in the state directory.
+
+from pathlib import Path
+import json
+import os
+import sys
+import time
+
+
+def main(args) -> int:
+    if len(args) > 1 and args[1] == '--version':
+        print('songrec 0.0.0 (fake)')
+        return 0
+    if len(args) != 3 or args[1] != 'audio-file-to-recognized-song':
+        print('usage: {} audio-file-to-recognized-song <file>'.format(args[0]), file=sys.stderr)
+        return 2
+
+    state_dir = Path(os.environ['FAKE_SONGREC_STATE_DIR'])
+    latency = float(os.environ.get('FAKE_SONGREC_LATENCY', '0.05'))
+    max_concurrent_path = state_dir.joinpath('max_concurrent')
+    max_concurrent = int(max_concurrent_path.read_text()) if max_concurrent_path.exists() else 1000
+
+    running_path = state_dir.joinpath('running_{}'.format(os.getpid()))
+    running_path.touch()
+    try:
+        running = len(list(state_dir.glob('running_*')))
+        with open(state_dir.joinpath('calls.log'), 'a') as f:
+            f.write('{} {}\n'.format(time.time(), running))
+        if running > max_concurrent:
+            print('Error: 429 Too Many Requests ({} running calls, at most {} allowed)'.format(running, max_concurrent), file=sys.stderr)
+            return 1
+        time.sleep(latency)
+    finally:
+        running_path.unlink()
+
+    name = Path(args[2]).stem
+    print(json.dumps({'track': {'title': name, 'subtitle': 'Fake Artist', 'key': name, 'sections': []}}))
+    return 0
+
+
+if __name__ == '__main__':
+    exit(main(sys.argv))
@@ -0,0 +1,46 @@
+import library
+from recognize import Track
+
+
+def make_track(path, fingerprint):
+    track = Track()
+    track.file_path = str(path)
+    track.title = 'Song'
+    track.artist = 'Artist'
+    track.fingerprint = fingerprint
+    return track
+
+
+def test_find_prefers_same_format(tmp_path):
+    track_library = library.Library(str(tmp_path.joinpath('library.db')))
+    existing_mp3 = tmp_path.joinpath('existing.mp3')
+    existing_flac = tmp_path.joinpath('existing.flac')
+    existing_mp3.write_text('')
+    existing_flac.write_text('')
+    # both formats of an earlier run, the lossless one ranks higher
+    track_library.add(make_track(existing_mp3, 'key'))
+    track_library.add(make_track(existing_flac, 'key'))
+
+    assert track_library.find(make_track(tmp_path.joinpath('new.mp3'), 'key'))['file_path'] == str(existing_mp3)
+    assert track_library.find(make_track(tmp_path.joinpath('new.flac'), 'key'))['file_path'] == str(existing_flac)
+    # no copy in the same format, the best other one
+    assert track_library.find(make_track(tmp_path.joinpath('new.ogg'), 'key'))['file_path'] == str(existing_flac)
+    track_library.close()
+
+
+def test_deduplicate_hardlinks_lossy_primary(tmp_path):
+    track_library = library.Library(str(tmp_path.joinpath('library.db')))
+    existing_mp3 = tmp_path.joinpath('existing.mp3')
+    existing_flac = tmp_path.joinpath('existing.flac')
+    existing_mp3.write_text('old')
+    existing_flac.write_text('old')
+    track_library.add(make_track(existing_mp3, 'key'))
+    track_library.add(make_track(existing_flac, 'key'))
+
+    fragment = tmp_path.joinpath('fragment.mp3')
+    fragment.write_text('new')
+    tracks = library.deduplicate_tracks([make_track(fragment, 'key')], track_library, 'hardlink')
+
+    assert tracks[0].library_duplicate
+    assert fragment.samefile(existing_mp3)
+    track_library.close()
@@ -0,0 +1,88 @@
+import pytest
+
+import rename
+from recognize import Track
+
+
+class FailingLibrary:
+    def move_all(self, moves):
+        raise RuntimeError('library update failed')
+
+
+def make_track(path, position, title, variant_paths=None):
+    track = Track()
+    track.position = position
+    track.file_path = str(path)
+    track.variant_paths = [str(p) for p in variant_paths or []]
+    track.title = title
+    track.artist = 'Artist'
+    return track
+
+
+def test_swap_is_rolled_back_when_library_update_fails(tmp_path):
+    a = tmp_path.joinpath('a')
+    b = tmp_path.joinpath('b')
+    a.write_text('A')
+    b.write_text('B')
+
+    with pytest.raises(RuntimeError):
+        rename.apply_renames([(str(a), str(b)), (str(b), str(a))], FailingLibrary())
+
+    assert a.read_text() == 'A'
+    assert b.read_text() == 'B'
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['a', 'b']
+
+
+def test_swap(tmp_path):
+    a = tmp_path.joinpath('a')
+    b = tmp_path.joinpath('b')
+    a.write_text('A')
+    b.write_text('B')
+
+    rename.apply_renames([(str(a), str(b)), (str(b), str(a))])
+
+    assert a.read_text() == 'B'
+    assert b.read_text() == 'A'
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['a', 'b']
+
+
+def test_resolve_collisions_adds_counter_to_all_formats():
+    targets = [
+        ['/mix/Unknown Title.mp3', '/mix/Unknown Title.flac'],
+        ['/mix/Song.mp3', '/mix/Song.flac'],
+        ['/mix/Unknown Title.mp3', '/mix/Unknown Title.flac'],
+        ['/mix/Unknown Title.mp3', '/mix/Unknown Title.flac'],
+    ]
+    assert rename.resolve_collisions(targets, False) == 2
+    assert targets == [
+        ['/mix/Unknown Title.mp3', '/mix/Unknown Title.flac'],
+        ['/mix/Song.mp3', '/mix/Song.flac'],
+        ['/mix/Unknown Title (2).mp3', '/mix/Unknown Title (2).flac'],
+        ['/mix/Unknown Title (3).mp3', '/mix/Unknown Title (3).flac'],
+    ]
+
+
+def test_resolve_collisions_restricted():
+    targets = [['/mix/Unknown_Title.mp3'], ['/mix/Unknown_Title.mp3']]
+    assert rename.resolve_collisions(targets, True) == 1
+    assert targets[1] == ['/mix/Unknown_Title_2.mp3']
+
+
+def test_rename_tracks(tmp_path):
+    media = tmp_path.joinpath('mix.mp3')
+    media.write_text('')
+    tracks = []
+    for i, title in enumerate([None, 'Song', None]):
+        fragment = tmp_path.joinpath('fragment_{}.mp3'.format(i))
+        variant = tmp_path.joinpath('fragment_{}.flac'.format(i))
+        fragment.write_text(str(i))
+        variant.write_text(str(i))
+        tracks.append(make_track(fragment, i, title, [variant]))
+
+    rename.rename_tracks(tracks, str(media), '%t', False)
+
+    assert [track.file_path for track in tracks] == [str(tmp_path.joinpath(name)) for name in ['Unknown Title.mp3', 'Song.mp3', 'Unknown Title (2).mp3']]
+    assert tracks[2].variant_paths == [str(tmp_path.joinpath('Unknown Title (2).flac'))]
+    assert [open(track.file_path).read() for track in tracks] == ['0', '1', '2']
+    assert sorted(p.name for p in tmp_path.iterdir()) == sorted(['mix.mp3', 'Unknown Title.mp3', 'Unknown Title.flac', 'Song.mp3', 'Song.flac',
+                                                                 'Unknown Title (2).mp3', 'Unknown Title (2).flac'])
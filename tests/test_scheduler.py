@@ -0,0 +1,65 @@
+from pathlib import Path
+import time
+
+import recognize
+import scheduler
+
+FAKE_SONGREC = str(Path(__file__).resolve().parent.joinpath('fake_songrec.py'))
+
+
+def recognize_with_fake(tmp_path, item):
+    return recognize.recognize_track(str(tmp_path.joinpath('{}.wav'.format(item))), item, FAKE_SONGREC)
+
+
+# the concurrency each call of the fake songrec saw, by start time
+def read_calls(state_dir):
+    with open(state_dir.joinpath('calls.log')) as f:
+        return [(float(start), int(running)) for start, running in (line.split() for line in f)]
+
+
+def test_limit_drops_under_throttling_and_recovers(tmp_path, monkeypatch):
+    state_dir = tmp_path.joinpath('state')
+    state_dir.mkdir()
+    monkeypatch.setenv('FAKE_SONGREC_STATE_DIR', str(state_dir))
+    # only errors reduce the limit, slow calls depend on the load of the machine
+    track_scheduler = scheduler.AdaptiveScheduler(8, 8, max_retries=20, retry_backoff=0.01, latency_factor=1000)
+    decrease_times = []
+    on_result = track_scheduler._on_result
+    def record_decrease(*args):
+        decreases = track_scheduler.decreases
+        on_result(*args)
+        if track_scheduler.decreases > decreases:
+            decrease_times.append(time.time())
+    track_scheduler._on_result = record_decrease
+
+    # throttled: more than 2 parallel calls fail
+    state_dir.joinpath('max_concurrent').write_text('2')
+    tracks = track_scheduler.map(lambda item: recognize_with_fake(tmp_path, item), list(range(30)))
+    assert [track.title for track in tracks] == [str(i) for i in range(30)]
+    metrics = track_scheduler.metrics()
+    assert metrics['errors'] > 0
+    assert metrics['decreases'] > 0
+    # after the first decrease the scheduler never again runs as many calls as at the start
+    assert max(running for start, running in read_calls(state_dir) if start > decrease_times[0]) < 8
+
+    # no more throttling: without errors the limit grows back to the maximum
+    state_dir.joinpath('max_concurrent').write_text('1000')
+    track_scheduler.map(lambda item: recognize_with_fake(tmp_path, item), list(range(60)))
+    assert track_scheduler.metrics()['errors'] == metrics['errors']
+    assert track_scheduler.metrics()['decreases'] == metrics['decreases']
+    assert track_scheduler.current_limit() == 8
+
+
+def test_latency_compared_per_cost():
+    track_scheduler = scheduler.AdaptiveScheduler(4, 4, max_retries=0)
+    # latency grows with the cost of the item, like songrec with longer fragments
+    track_scheduler.map(lambda item: time.sleep(0.01 * item), [1, 1, 1, 1, 5, 5, 10, 10], cost=lambda item: item)
+    assert track_scheduler.metrics()['decreases'] == 0
+
+
+def test_new_baseline_for_other_cost():
+    track_scheduler = scheduler.AdaptiveScheduler(4, 4, max_retries=0)
+    # same latency, but once per 60 seconds of audio and once without a cost like the rechecks
+    track_scheduler.map(lambda item: time.sleep(0.02), list(range(8)), cost=lambda item: 60)
+    track_scheduler.map(lambda item: time.sleep(0.02), list(range(8)))
+    assert track_scheduler.metrics()['decreases'] == 0
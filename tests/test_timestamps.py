@@ -0,0 +1,33 @@
+import timestamps
+
+CUE_SHEET = '''PERFORMER "Various"
+TITLE "Café Mix"
+FILE "mix.mp3" MP3
+  TRACK 01 AUDIO
+    TITLE "Déjà Vu"
+    PERFORMER "Beyoncé"
+    INDEX 01 00:00:00
+  TRACK 02 AUDIO
+    TITLE "Über"
+    INDEX 01 03:20:37
+'''
+
+
+def check_entries(entries):
+    assert [(entry.title, entry.artist, entry.album) for entry in entries] == [
+        ('Déjà Vu', 'Beyoncé', 'Café Mix'),
+        ('Über', 'Various', 'Café Mix'),
+    ]
+    assert entries[1].start == 200 + 37 / timestamps.CUE_FRAMES_PER_SECOND
+
+
+def test_cue_utf8_with_bom(tmp_path):
+    cue_path = tmp_path.joinpath('mix.cue')
+    cue_path.write_bytes(CUE_SHEET.encode('utf-8-sig'))
+    check_entries(timestamps.get_tracklist(str(cue_path)))
+
+
+def test_cue_cp1252(tmp_path):
+    cue_path = tmp_path.joinpath('mix.cue')
+    cue_path.write_bytes(CUE_SHEET.encode('cp1252'))
+    check_entries(timestamps.get_tracklist(str(cue_path)))
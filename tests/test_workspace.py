@@ -0,0 +1,19 @@
+import subprocess
+
+import pytest
+
+import workspace
+
+
+@pytest.mark.parametrize('output, expected', [
+    # lossy codecs have no bits per sample
+    ('sample_rate=44100\nchannels=2\nbits_per_sample=0\nbits_per_raw_sample=N/A\n', (44100, 2, True)),
+    ('sample_rate=44100\nchannels=1\nbits_per_sample=0\nbits_per_raw_sample=16\n', (44100, 1, True)),
+    ('sample_rate=96000\nchannels=2\nbits_per_sample=0\nbits_per_raw_sample=24\n', (96000, 2, False)),
+    ('sample_rate=48000\nchannels=2\nbits_per_sample=24\nbits_per_raw_sample=N/A\n', (48000, 2, False)),
+    ('sample_rate=48000\nchannels=6\nbits_per_sample=0\nbits_per_raw_sample=N/A\n', (48000, 2, False)),
+    ('', (workspace.DEFAULT_SAMPLE_RATE, workspace.DEFAULT_CHANNELS, False)),
+])
+def test_probe_audio_format(monkeypatch, output, expected):
+    monkeypatch.setattr(subprocess, 'run', lambda *args, **kwargs: subprocess.CompletedProcess(args, 0, output, ''))
+    assert workspace.probe_audio_format('media.flac') == expected
@@ -1,123 +1,224 @@
 #!/usr/bin/env python3
 
 from loguru import logger
-from typing import List
+from typing import Iterable, List
+from pathlib import Path
 from sys import stdin
+import json
 import re
 import datetime
 
 
-class Pattern:
-    def __init__(self):
-        self.pattern = None
+# A single entry of a track list.
+# Depending on the source, only the start is known or also title and artist.
+class TracklistEntry:
+    def __init__(self, start: float, title: str or None = None, artist: str or None = None, album: str or None = None):
+        # seconds from the start of the media
+        self.start = start
+        self.title = title
+        self.artist = artist
+        self.album = album
+        # whether the start is more accurate than a full second
+        self.precise = False
 
-    def process(self, m):
-        return None
+    def __str__(self) -> str:
+        return 'Entry at {}: title {}, artist {}, album {}'.format(
+            format_timestamp(self.start), self.title, self.artist, self.album)
 
-    def match(self, str):
-        m = self.pattern.search(str)
-        if not m:
-            return None
-        return self.process(m)
+    def is_known(self) -> bool:
+        return self.title is not None and self.artist is not None
 
 
-class Pattern1(Pattern):
-    def __init__(self):
-        self.pattern = re.compile(r'(\d{1,2}):(\d{1,2}):(\d{1,2})')
+# Matches all supported formats in a single pass, the first match on a line wins:
+# hh:mm:ss, mm:ss, hh.mm.ss and mm.ss. Both separators must be the same.
+# The colon formats can have fractional seconds, e.g. mm:ss.mmm or hh:mm:ss,mmm.
+timestamp_pattern = re.compile(r'(\d{1,2})([:.])(\d{1,2})(?:\2(\d{1,2}))?(?:[.,](\d{1,3})(?!\d))?')
 
-    def process(self, m):
-        hours = int(m.group(1))
-        minutes = int(m.group(2))
-        seconds = int(m.group(3))
+# CUE INDEX times are mm:ss:ff with 75 frames per second
+cue_index_pattern = re.compile(r'^\s*INDEX\s+01\s+(\d+):(\d{1,2}):(\d{1,2})\s*$')
+cue_quoted_pattern = re.compile(r'^\s*(TITLE|PERFORMER)\s+"?(.*?)"?\s*$')
+cue_track_pattern = re.compile(r'^\s*TRACK\s+\d+')
 
-        totalseconds = seconds + minutes * 60 + hours * 3600
-        return totalseconds, m.start()
+# separates artist and title in chapter titles and descriptions
+artist_title_separator = re.compile(r'\s+[-–—]\s+')
+# leading track numbers like "1. " or "01) "
+track_number_prefix = re.compile(r'^\d+[.)]\s+')
 
-class Pattern2(Pattern):
-    def __init__(self):
-        self.pattern = re.compile(r'(\d{1,2}):(\d{1,2})')
+CUE_FRAMES_PER_SECOND = 75
 
-    def process(self, m):
-        minutes = int(m.group(1))
-        seconds = int(m.group(2))
 
-        totalseconds = seconds + minutes * 60
-        return totalseconds, m.start()
+def check_arguments(args) -> bool:
+    return True
 
-class Pattern3(Pattern):
-    def __init__(self):
-        self.pattern = re.compile(r'(\d{1,2})\.(\d{1,2})\.(\d{1,2})')
 
-    def process(self, m):
-        hours = int(m.group(1))
-        minutes = int(m.group(2))
-        seconds = int(m.group(3))
+def format_timestamp(seconds: float) -> str:
+    return str(datetime.timedelta(seconds=seconds))
 
-        totalseconds = seconds + minutes * 60 + hours * 3600
-        return totalseconds, m.start()
 
-class Pattern4(Pattern):
-    def __init__(self):
-        self.pattern = re.compile(r'(\d{1,2})\.(\d{1,2})')
+# Returns the first timestamp on the line and the match or None if there is none.
+def scan_line(line: str):
+    m = timestamp_pattern.search(line)
+    if not m:
+        return None
+    first, separator, second, third, fraction = m.groups()
+    if third is not None:
+        seconds = int(third) + int(second) * 60 + int(first) * 3600
+    else:
+        seconds = int(second) + int(first) * 60
+    entry = TracklistEntry(seconds)
+    # the dotted formats can not have a fraction, the dot is the separator there
+    if fraction is not None and separator == ':':
+        entry.start += int(fraction) / 10 ** len(fraction)
+        entry.precise = True
+    return entry, m
+
+
+# Splits "Artist - Title" into artist and title, None for anything missing.
+def parse_artist_title(text: str):
+    text = track_number_prefix.sub('', text.strip(' \t-–—|:'))
+    if len(text) == 0:
+        return None, None
+    parts = artist_title_separator.split(text, 1)
+    if len(parts) == 2 and len(parts[0]) > 0 and len(parts[1]) > 0:
+        return parts[0].strip(), parts[1].strip()
+    return None, text
+
+
+# Parses free text like a track list file, stdin or a video description.
+# If parse_titles is set, the text around the timestamp is used as "Artist - Title".
+def scan_lines(lines: Iterable[str], parse_titles: bool = False) -> List[TracklistEntry]:
+    entries = []
+    for line in lines:
+        line = line.strip()
+        if len(line) == 0:
+            continue
+        logger.trace('Matching line "{}".', line)
+        ret = scan_line(line)
+        if ret is None:
+            continue
+        entry, m = ret
+        if parse_titles:
+            # either "00:00 Artist - Title" or "Artist - Title 00:00"
+            text = line[m.end():]
+            if len(text.strip(' \t-–—|:')) == 0:
+                text = line[:m.start()]
+            entry.artist, entry.title = parse_artist_title(text)
+        entries.append(entry)
+        logger.trace('Found timestamp {} ({}) in "{}".', entry.start, format_timestamp(entry.start), line)
+    return entries
+
+
+def read_stdin_lines() -> Iterable[str]:
+    print('Paste timestamps below. Terminate with two empty lines or EOF (CTRL-D).')
+    empty_lines = 0
+    # loops until EOF
+    for line in stdin:
+        # break after two empty lines
+        if len(line.strip()) == 0:
+            empty_lines += 1
+            if empty_lines >= 2:
+                break
+            continue
 
-    def process(self, m):
-        minutes = int(m.group(1))
-        seconds = int(m.group(2))
+        empty_lines = 0
+        yield line
 
-        totalseconds = seconds + minutes * 60
-        return totalseconds, m.start()
 
-patterns = [
-    Pattern1(),
-    Pattern2(),
-    Pattern3(),
-    Pattern4(),
-]
+def parse_cue(lines: Iterable[str]) -> List[TracklistEntry]:
+    entries = []
+    album = None
+    album_artist = None
+    current = None
+    for line in lines:
+        if cue_track_pattern.match(line):
+            current = TracklistEntry(0, artist=album_artist, album=album)
+            current.precise = True
+            continue
+        m = cue_quoted_pattern.match(line)
+        if m:
+            key, value = m.group(1), m.group(2)
+            # before the first TRACK the values describe the whole album
+            if current is None:
+                if key == 'TITLE':
+                    album = value
+                else:
+                    album_artist = value
+            elif key == 'TITLE':
+                current.title = value
+            else:
+                current.artist = value
+            continue
+        m = cue_index_pattern.match(line)
+        if m and current is not None:
+            minutes, seconds, frames = (int(g) for g in m.groups())
+            current.start = minutes * 60 + seconds + frames / CUE_FRAMES_PER_SECOND
+            entries.append(current)
+            logger.trace('Found CUE track {}.', current)
+    return entries
+
+
+# CUE sheets written by rippers are often cp1252 or UTF-8 with a BOM, the first is used if the file is no valid UTF-8.
+def read_cue_lines(cue_path: str) -> List[str]:
+    with open(cue_path, 'rb') as f:
+        data = f.read()
+    try:
+        text = data.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        logger.debug('{} is not UTF-8, reading it as cp1252.', cue_path)
+        text = data.decode('cp1252', errors='replace')
+    return text.splitlines()
+
+
+def get_info_json_path(media_file_path: str) -> Path:
+    return Path(media_file_path).with_suffix('.info.json')
+
+
+# Uses the chapters from the yt-dlp info JSON, falls back to timestamps in the description.
+def parse_info_json(info_json_path: str) -> List[TracklistEntry]:
+    with open(info_json_path, 'r') as f:
+        info = json.load(f)
+
+    chapters = info.get('chapters') or []
+    if len(chapters) > 0:
+        logger.debug('Using {} chapters from {}.', len(chapters), info_json_path)
+        entries = []
+        for chapter in chapters:
+            entry = TracklistEntry(float(chapter['start_time']))
+            entry.precise = entry.start != int(entry.start)
+            entry.artist, entry.title = parse_artist_title(chapter.get('title') or '')
+            entries.append(entry)
+        return entries
+
+    description = info.get('description') or ''
+    logger.debug('No chapters in {}, scanning the description.', info_json_path)
+    return scan_lines(description.splitlines(), parse_titles=True)
+
+
+# Reads the track list from
+# - a CUE sheet (.cue),
+# - the chapters or the description of the yt-dlp info JSON (.info.json),
+# - stdin ("stdin") or any other text file, taking the first timestamp of each line.
+def get_tracklist(timestamps_file_path: str) -> List[TracklistEntry]:
+    logger.trace('Parsing track list from {}.', timestamps_file_path)
+    if timestamps_file_path == 'stdin':
+        entries = scan_lines(read_stdin_lines())
+    elif timestamps_file_path.lower().endswith('.info.json'):
+        entries = parse_info_json(timestamps_file_path)
+    elif timestamps_file_path.lower().endswith('.cue'):
+        entries = parse_cue(read_cue_lines(timestamps_file_path))
+    else:
+        # iterate instead of reading the whole file
+        with open(timestamps_file_path, 'r') as f:
+            entries = scan_lines(f)
 
-def check_arguments(args) -> bool:
-    return True
+    logger.debug('Parsed {} timestamps from {}.', len(entries), timestamps_file_path)
+    return entries
 
 
-def format_timestamp(seconds: int) -> str:
-    return str(datetime.timedelta(seconds=seconds))
+def get_timestamps(timestamps_file_path: str) -> List[float]:
+    return [entry.start for entry in get_tracklist(timestamps_file_path)]
 
-def get_timestamps(timestamps_file_path: str) -> List[int]:
-    logger.trace('Parsing timestamps from {}.', timestamps_file_path)
-    lines = []
-    if timestamps_file_path == 'stdin':
-        print('Paste timestamps below. Terminate with two empty lines or EOF (CTRL-D).')
-        empty_lines = 0
-        # loops until EOF
-        for line in stdin:
-            # break after two empty lines
-            if len(line.strip()) == 0:
-                empty_lines += 1
-                if empty_lines >= 2:
-                    break
-                continue
-            
-            empty_lines = 0
-            lines.append(line.strip())
-    else:
-        lines = list(open(timestamps_file_path, 'r').readlines())
-    
-    logger.trace('Read {} lines from {}.', len(lines), timestamps_file_path)
-    
-    timestamps = []
-    for line in lines:
-        matches = []
-        if len(line.strip()) == 0:
-            continue
-        logger.trace('Matching line "{}".', line)
-        for pattern in patterns:
-            m = pattern.match(line)
-            if m is not None:
-                matches.append(m)
-        logger.trace('Matches: {}.', matches)
-        if len(matches) > 0:
-            seconds = min(matches, key=lambda v : v[1])[0]
-            timestamps.append(seconds)
-            logger.trace('Found timestamp {} ({}) in "{}".', seconds, format_timestamp(seconds), line)
-    
-    logger.debug('Parsed {} timestamps from {}.', len(timestamps), timestamps_file_path)
-    return timestamps
+
+# The entries are precise if every start after the first is, the first usually is 0 anyway.
+def is_precise(entries: List[TracklistEntry]) -> bool:
+    return len(entries) > 1 and all(entry.precise for entry in entries[1:])
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+
+from loguru import logger
+from pathlib import Path
+import mmap
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+
+# format of the decoded audio, 16 bit signed little endian
+PCM_FORMAT = 's16le'
+BYTES_PER_SAMPLE = 2
+DEFAULT_SAMPLE_RATE = 44100
+DEFAULT_CHANNELS = 2
+MAX_CHANNELS = 2
+
+
+# The media decoded once to raw PCM and memory-mapped.
+# All stages needing the audio (recognition excerpts, rechecks, splitting) read slices of it
+# instead of decoding the media again. If the source has more than 16 bits or 2 channels (lossless is False),
+# the split does not use it, the fragments would lose quality.
+class PcmWorkspace:
+    def __init__(self, media_file_path: str, max_size: int, directory: str or None = None):
+        self.media_file_path = str(media_file_path)
+        self.max_size = max_size
+        self.sample_rate, self.channels, self.lossless = probe_audio_format(self.media_file_path)
+        self.directory = tempfile.mkdtemp(prefix='extractnsplit_', dir=directory)
+        self.pcm_path = os.path.join(self.directory, 'media.pcm')
+        self.pcm_file = None
+        self.buffer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def frame_size(self) -> int:
+        return self.channels * BYTES_PER_SAMPLE
+
+    def bytes_per_second(self) -> int:
+        return self.sample_rate * self.frame_size()
+
+    def duration(self) -> float:
+        return len(self.buffer) / self.bytes_per_second()
+
+    # Decodes the media, returns False if it would not fit into the disk budget.
+    def create(self, media_duration: float or None) -> bool:
+        if media_duration is not None:
+            expected_size = int(media_duration * self.bytes_per_second())
+            free = shutil.disk_usage(self.directory).free
+            if expected_size > self.max_size or expected_size > free:
+                logger.warning('Decoded media would need {} MiB, budget is {} MiB with {} MiB free, not using a workspace.',
+                    expected_size // 2**20, self.max_size // 2**20, free // 2**20)
+                return False
+
+        ffmpeg_args = [
+            'ffmpeg',
+            '-loglevel', 'error',
+            '-y',
+            '-hide_banner',
+            '-i', self.media_file_path,
+            '-vn',
+            '-f', PCM_FORMAT,
+            '-ar', str(self.sample_rate),
+            '-ac', str(self.channels),
+            # stop early instead of filling the disk if the duration was unknown or wrong
+            '-fs', str(self.max_size),
+            self.pcm_path,
+        ]
+        logger.trace('Decoding media to workspace: {}.', ffmpeg_args)
+        proc = subprocess.run(ffmpeg_args, capture_output=True, text=True)
+        if proc.returncode != 0:
+            logger.error('Decoding {} to the workspace failed with code {}, stderr: {}.', self.media_file_path, proc.returncode, proc.stderr)
+            return False
+        if os.path.getsize(self.pcm_path) >= self.max_size:
+            logger.warning('Decoded media exceeds the budget of {} MiB, not using a workspace.', self.max_size // 2**20)
+            os.remove(self.pcm_path)
+            return False
+
+        self.pcm_file = open(self.pcm_path, 'rb')
+        self.buffer = mmap.mmap(self.pcm_file.fileno(), 0, access=mmap.ACCESS_READ)
+        logger.debug('Decoded {} to workspace {} ({:.1f}s, {} MiB).', self.media_file_path, self.pcm_path, self.duration(), len(self.buffer) // 2**20)
+        return True
+
+    def close(self) -> None:
+        if self.buffer is not None:
+            self.buffer.close()
+            self.buffer = None
+        if self.pcm_file is not None:
+            self.pcm_file.close()
+            self.pcm_file = None
+        shutil.rmtree(self.directory, ignore_errors=True)
+        logger.trace('Removed workspace {}.', self.directory)
+
+    # Zero-copy view of the audio from start to end (seconds), end None means until the end.
+    def slice(self, start: float, end: float or None = None) -> memoryview:
+        start_byte = max(0, int(start * self.sample_rate)) * self.frame_size()
+        end_byte = len(self.buffer) if end is None else int(end * self.sample_rate) * self.frame_size()
+        end_byte = min(len(self.buffer), end_byte)
+        return memoryview(self.buffer)[start_byte:max(start_byte, end_byte)]
+
+    # Writes the audio from start to end as WAV file, e.g. for songrec which needs a file.
+    def write_wav(self, start: float, end: float or None, file_path: str) -> str:
+        data = self.slice(start, end)
+        with open(file_path, 'wb') as f:
+            f.write(wav_header(len(data), self.sample_rate, self.channels))
+            f.write(data)
+        data.release()
+        return file_path
+
+    def temp_path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    # ffmpeg input options to read the audio of this workspace from stdin
+    def ffmpeg_input_args(self):
+        return ['-f', PCM_FORMAT, '-ar', str(self.sample_rate), '-ac', str(self.channels), '-i', 'pipe:0']
+
+
+def wav_header(data_size: int, sample_rate: int, channels: int) -> bytes:
+    block_align = channels * BYTES_PER_SAMPLE
+    return struct.pack('<4sI4s4sIHHIIHH4sI',
+        b'RIFF', 36 + data_size, b'WAVE',
+        b'fmt ', 16, 1, channels, sample_rate, sample_rate * block_align, block_align, BYTES_PER_SAMPLE * 8,
+        b'data', data_size)
+
+
+def parse_bits(value: str or None) -> int:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        # N/A, e.g. for lossy codecs
+        return 0
+
+
+# Sample rate and number of channels of the first audio stream, defaults if unknown,
+# and whether the workspace holds the audio without loss, which is not the case for more than 16 bits or 2 channels.
+# Lossy codecs report no bits per sample, their decoded audio fits into 16 bits.
+def probe_audio_format(media_file_path: str):
+    ffprobe_args = [
+        'ffprobe',
+        '-loglevel', 'error',
+        '-select_streams', 'a:0',
+        '-show_entries', 'stream=sample_rate,channels,bits_per_sample,bits_per_raw_sample',
+        '-of', 'default=noprint_wrappers=1',
+        media_file_path,
+    ]
+    try:
+        proc = subprocess.run(ffprobe_args, capture_output=True, text=True)
+        values = dict(line.split('=', 1) for line in proc.stdout.splitlines() if '=' in line)
+        channels = int(values['channels'])
+        bits = max(parse_bits(values.get('bits_per_sample')), parse_bits(values.get('bits_per_raw_sample')))
+        return int(values['sample_rate']), min(MAX_CHANNELS, channels), channels <= MAX_CHANNELS and bits <= BYTES_PER_SAMPLE * 8
+    except (OSError, KeyError, ValueError) as e:
+        logger.debug('Unable to probe audio format of {}, using defaults: {}', media_file_path, e)
+        return DEFAULT_SAMPLE_RATE, DEFAULT_CHANNELS, False
+
+
+def check_arguments(args) -> bool:
+    if args.workspace_max_size <= 0:
+        print('--workspace-max-size must be positive.')
+        return False
+    if args.workspace_dir is not None and not Path(args.workspace_dir).is_dir():
+        print('--workspace-dir {} is not a directory.'.format(args.workspace_dir))
+        return False
+    return True
+
+
+# Returns a ready workspace or None if disabled or the media does not fit into the budget.
+def get_workspace_from_arguments(args, media_file_path: str, media_duration: float or None) -> PcmWorkspace or None:
+    if not args.workspace:
+        return None
+    workspace = PcmWorkspace(media_file_path, args.workspace_max_size * 2**20, args.workspace_dir)
+    if not workspace.create(media_duration):
+        workspace.close()
+        return None
+    return workspace